@@ -0,0 +1,272 @@
+import functools
+import ipaddress
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+# Index file: header, then per address family the interval starts, ends
+# and AS numbers. IPv4 keys are the address, IPv6 keys its upper 64 bits,
+# which holds every prefix up to /64.
+INDEX_MAGIC = b"AUDASN01"
+INDEX_HDR = struct.Struct("=8s Q Q")
+INDEX_SUFFIX = ".idx"
+KEY_DTYPES = {4: np.uint32, 6: np.uint64}
+
+
+def address_key(addr):
+    if addr.version == 4:
+        return int(addr)
+    return int(addr) >> 64
+
+
+def parse_line(line):
+    """Returns (version, start, end, asn) for a "prefix,asn[,...]" or a
+    "first,last,asn[,...]" line, comma or tab separated, else None."""
+
+    fields = line.replace("\t", ",").split(",")
+    try:
+        if "/" in fields[0]:
+            net = ipaddress.ip_network(fields[0].strip(), strict=False)
+            first, last = net.network_address, net.broadcast_address
+            asn = fields[1]
+        else:
+            first = ipaddress.ip_address(fields[0].strip())
+            last = ipaddress.ip_address(fields[1].strip())
+            asn = fields[2]
+        asn = int(asn.strip().upper().replace("AS", ""))
+    except (ValueError, IndexError):
+        return None
+
+    if first.version != last.version or last < first:
+        return None
+    return first.version, address_key(first), address_key(last), asn
+
+
+def flatten(intervals):
+    """Turn possibly nested (start, end, asn) intervals into disjoint
+    ones, each point keeping the AS of the narrowest interval covering it
+    (the longest prefix)."""
+
+    out = []
+    stack = []  # (end, asn) of the intervals enclosing pos
+    pos = 0
+
+    for start, end, asn in sorted(intervals, key=lambda i: (i[0], -i[1])):
+        while stack and stack[-1][0] < start:
+            top_end, top_asn = stack.pop()
+            if pos <= top_end:
+                out.append((pos, top_end, top_asn))
+                pos = top_end + 1
+
+        if stack and pos < start:
+            out.append((pos, start - 1, stack[-1][1]))
+
+        stack.append((end, asn))
+        pos = start
+
+    while stack:
+        top_end, top_asn = stack.pop()
+        if pos <= top_end:
+            out.append((pos, top_end, top_asn))
+            pos = top_end + 1
+
+    return out
+
+
+def build_tables(source):
+    """Parse a dataset into {version: (starts, ends, asns)} arrays."""
+
+    intervals = {4: [], 6: []}
+    skipped = 0
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            entry = parse_line(line)
+            if entry is None:
+                skipped += 1
+                continue
+            version, start, end, asn = entry
+            intervals[version].append((start, end, asn))
+
+    if skipped:
+        logging.warning("%s: skipped %d unparsable lines", source, skipped)
+
+    tables = {}
+    for ver in (4, 6):
+        cols = list(zip(*flatten(intervals[ver]))) or [(), (), ()]
+        tables[ver] = (
+            np.array(cols[0], dtype=KEY_DTYPES[ver]),
+            np.array(cols[1], dtype=KEY_DTYPES[ver]),
+            np.array(cols[2], dtype=np.uint32),
+        )
+    return tables
+
+
+def write_index(index, tables):
+    tmp = index + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(
+            INDEX_HDR.pack(INDEX_MAGIC, len(tables[4][0]), len(tables[6][0]))
+        )
+        for ver in (4, 6):
+            for arr in tables[ver]:
+                arr.tofile(f)
+    os.replace(tmp, index)
+
+
+def map_index(index):
+    """Memory-map the arrays of an index file, returns {version: (starts,
+    ends, asns)}."""
+
+    with open(index, "rb") as f:
+        magic, n4, n6 = INDEX_HDR.unpack(f.read(INDEX_HDR.size))
+    if magic != INDEX_MAGIC:
+        raise ValueError("not an AS index: %s" % index)
+
+    tables = {}
+    offset = INDEX_HDR.size
+    for ver, count in ((4, n4), (6, n6)):
+        arrays = []
+        for dtype in (KEY_DTYPES[ver], KEY_DTYPES[ver], np.uint32):
+            size = count * np.dtype(dtype).itemsize
+            if count:
+                arrays.append(
+                    np.memmap(
+                        index,
+                        dtype=dtype,
+                        mode="r",
+                        offset=offset,
+                        shape=(count,),
+                    )
+                )
+            else:
+                arrays.append(np.zeros(0, dtype=dtype))
+            offset += size
+        tables[ver] = tuple(arrays)
+
+    return tables
+
+
+class ASResolver:
+    """Maps addresses to AS numbers from a prefix-to-ASN dataset on disk.
+
+    The dataset is a CSV (or TSV) of "prefix,asn" or "first,last,asn"
+    lines, as found in routing table and IP-to-ASN dumps. It is compiled
+    once into disjoint sorted intervals in a binary index next to it,
+    which is memory-mapped and binary searched, so loading is cheap and
+    the pages are shared between processes; where the index cannot be
+    written, the intervals are kept in memory. The dataset is loaded on
+    the first lookup and reloaded when its mtime changes, checked at most
+    every check_interval seconds, also after a failed load. Lookups go
+    through an LRU cache.
+    """
+
+    def __init__(self, path, cache_size=4096, check_interval=60):
+        self.path = path
+        self.index = path + INDEX_SUFFIX
+        self.check_interval = check_interval
+        self.tables = None
+        self.mtime = None
+        self.checked = None
+        self.loads = 0
+        self.lookups = 0
+        self.cached = functools.lru_cache(maxsize=cache_size)(self.find)
+
+    def __len__(self):
+        if self.tables is None:
+            return 0
+        return sum(len(starts) for starts, _, _ in self.tables.values())
+
+    def as_dict(self):
+        cache = self.cached.cache_info()
+        return {
+            "path": self.path,
+            "intervals": len(self),
+            "loads": self.loads,
+            "lookups": self.lookups,
+            "cache_hits": cache.hits,
+            "cache_size": cache.currsize,
+        }
+
+    def load(self):
+        # Recorded first: a dataset that fails to load is not parsed
+        # again until it changes
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+        try:
+            if os.stat(self.index).st_mtime_ns >= self.mtime:
+                self.set_tables(map_index(self.index))
+                return
+        except (OSError, ValueError):
+            pass  # missing, unreadable or not an index: rebuild it
+
+        start_t = time.time()
+        tables = build_tables(self.path)
+        try:
+            write_index(self.index, tables)
+            tables = map_index(self.index)
+        except (OSError, ValueError) as e:
+            # E.g. a read-only mount: serve from memory instead
+            logging.warning(
+                "AS index %s not written, kept in memory: %s",
+                self.index,
+                str(e),
+            )
+        logging.info(
+            "Compiled AS index %s in %f seconds",
+            self.index,
+            round(time.time() - start_t, 3),
+        )
+        self.set_tables(tables)
+
+    def set_tables(self, tables):
+        self.tables = tables
+        self.loads += 1
+        self.cached.cache_clear()
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if self.checked is not None and (
+            now - self.checked < self.check_interval
+        ):
+            return
+        self.checked = now
+
+        try:
+            if os.stat(self.path).st_mtime_ns != self.mtime:
+                self.load()
+        except (OSError, ValueError) as e:
+            if self.tables is None:
+                # Nothing to fall back on: resolve nothing, retry later
+                self.tables = {}
+            logging.warning(
+                "AS dataset %s not loaded: %s",
+                self.path,
+                str(type(e).__name__),
+            )
+
+    def lookup(self, addr):
+        """AS number of an ipaddress address, or None."""
+
+        self.lookups += 1
+        self.maybe_reload()
+        return self.cached(addr)
+
+    def find(self, addr):
+        table = self.tables.get(addr.version)
+        if table is None:
+            return None
+
+        starts, ends, asns = table
+        # Typed, so that uint64 keys are not compared as floats
+        key = starts.dtype.type(address_key(addr))
+        i = int(np.searchsorted(starts, key, side="right")) - 1
+        if i < 0 or key > ends[i]:
+            return None
+        return int(asns[i])
@@ -1,17 +1,20 @@
+import bisect
 import json
 import logging
-import statistics
+import math
 import time
 import uuid
-from collections import Counter, deque
+from array import array
+from collections import deque
 from datetime import datetime, timezone
 from enum import Enum
 from typing import NamedTuple
 
 # Local imports
-import websocket
+import features
+import sketch
 
-l4proto = {1: "ICMP", 2: "IGMP", 6: "TCP", 17: "UDP"}
+l4proto = {1: "ICMP", 2: "IGMP", 6: "TCP", 17: "UDP", 58: "ICMPv6"}
 
 
 class ACLKey(NamedTuple):
@@ -39,6 +42,10 @@ class Category(Enum):
     NovelFlow = 2
     FrequentFlow = 3
     PacketExchangeMimatch = 4
+    ServiceFanIn = 5
+    HeavyHitter = 6
+    TrafficDeviation = 7
+    HalfOpenFlood = 8
 
 
 class Severity(Enum):
@@ -48,9 +55,18 @@ class Severity(Enum):
     Alarming = 4
 
 
+def utc_time(t_ns):
+    return datetime.fromtimestamp(t_ns // 1000000000, timezone.utc)
+
+
 class Anomaly:
-    def __init__(self, category=Category.Undefined, conn=None, score=0.0):
-        self.time = datetime.now(timezone.utc).replace(microsecond=0)
+    def __init__(
+        self, category=Category.Undefined, conn=None, score=0.0, now=None
+    ):
+        # now is on the clock of the AUD, in ns
+        if now is None:
+            now = time.time_ns()
+        self.time = utc_time(now)
         self.uuid = uuid.uuid4()
         self.conn = conn
 
@@ -64,12 +80,34 @@ class Anomaly:
         self.severity = Severity.Unknown
         self.score = score
 
-        self.post_to_dht()
+        # Repeated detections of the same thing update the open anomaly
+        self.count = 1
+        self.last_seen = self.time
+        self.seen = now
+        self.last_published = None  # ns, like seen
+
+        self.seq = None  # position in an AnomalyStore log
+        self.serialized = None
+
+    def update(self, score, now=None):
+        if now is None:
+            now = time.time_ns()
+        self.score = score
+        self.count += 1
+        self.last_seen = utc_time(now)
+        self.seen = now
+        self.serialized = None
 
     def as_dict(self):
+        # Built once per change, the result must not be modified
+        if self.serialized is None:
+            self.serialized = self.build_dict()
+        return self.serialized
+
+    def build_dict(self):
         acl_key = self.conn.get_acl_key()
 
-        if acl_key.proto == 1:
+        if acl_key.proto in (1, 58):
             svc_port = None
         else:
             svc_port = acl_key.svc_port
@@ -88,11 +126,13 @@ class Anomaly:
             "category": str(self.category.name),
             "severity": str(self.severity.name),
             "score": str(round(self.score, 3)),
+            "count": self.count,
+            "last_seen": str(self.last_seen),
             "details": details,
         }
 
-    def post_to_dht(self):
-        payload = {
+    def dht_payload(self):
+        return {
             "RequestPostTopicUUID": {
                 "topic_name": self.topic_name,
                 "topic_uuid": str(self.topic_uuid),
@@ -104,53 +144,261 @@ class Anomaly:
             }
         }
 
-        try:
-            logging.debug(
-                "post_to_dht() payload: %s", str(json.dumps(payload))
-            )
-            ws = websocket.create_connection("ws://localhost:3000/ws")
-            ws.send(json.dumps(payload))
-            ws.close()
 
-        except Exception as e:
-            logging.debug(
-                "post_to_dht() failed. Reason: %s", str(type(e).__name__)
-            )
+class AnomalyStore:
+    """Recent anomalies, indexed by UUID, category and update time.
+
+    Adding or updating an anomaly appends it to a log under a new
+    sequence number, which is what pagination cursors refer to. The log
+    entries an anomaly leaves behind when updated or removed go stale and
+    are compacted away once they make up half of the log.
+    """
+
+    def __init__(self, retention=1000, clock=time.time):
+        if retention < 1:
+            # Nothing to evict to make room for a new anomaly
+            raise ValueError("anomaly retention must be at least 1")
+        self.retention = retention
+        self.clock = clock  # UNIX time, in seconds
+        self.by_uuid = dict()
+        self.by_seq = dict()  # seq -> anomaly, for its latest entry only
+        self.by_category = dict()  # Category -> seqs of its entries
+        self.seqs = []  # the log, ascending
+        self.times = []  # update time of each entry, ascending
+        self.head = 0  # entries before head are stale
+        self.next_seq = 0
+
+    def __len__(self):
+        return len(self.by_uuid)
+
+    def __contains__(self, anomaly):
+        return anomaly.uuid in self.by_uuid
+
+    def __iter__(self):
+        return (self.by_seq[seq] for seq in self.seqs if seq in self.by_seq)
+
+    def as_dict(self):
+        return {
+            "anomalies": len(self.by_uuid),
+            "retention": self.retention,
+            "log": len(self.seqs),
+            "categories": {
+                category.name: len(seqs)
+                for category, seqs in self.by_category.items()
+            },
+        }
+
+    def add(self, anomaly):
+        """Add a new anomaly or log an update of a stored one."""
+
+        if anomaly.uuid in self.by_uuid:
+            del self.by_seq[anomaly.seq]
+        else:
+            self.by_uuid[anomaly.uuid] = anomaly
+            if len(self.by_uuid) > self.retention:
+                self.remove(self.oldest().uuid)
+
+        seq = self.next_seq
+        self.next_seq += 1
+        anomaly.seq = seq
+
+        self.by_seq[seq] = anomaly
+        self.seqs.append(seq)
+        self.times.append(self.clock())
+        self.by_category.setdefault(anomaly.category, []).append(seq)
+
+        if len(self.seqs) > 2 * len(self.by_seq) + 64:
+            self.compact()
+
+    def get(self, anomaly_uuid):
+        return self.by_uuid.get(anomaly_uuid)
+
+    def remove(self, anomaly_uuid):
+        anomaly = self.by_uuid.pop(anomaly_uuid, None)
+        if anomaly is not None:
+            del self.by_seq[anomaly.seq]
+        return anomaly
+
+    def clear(self):
+        self.by_uuid.clear()
+        self.compact()
+
+    def oldest(self):
+        while self.seqs[self.head] not in self.by_seq:
+            self.head += 1
+        return self.by_seq[self.seqs[self.head]]
+
+    def compact(self):
+        if len(self.by_seq) != len(self.by_uuid):
+            self.by_seq = {a.seq: a for a in self.by_uuid.values()}
+
+        live = [
+            (seq, t)
+            for seq, t in zip(self.seqs, self.times)
+            if seq in self.by_seq
+        ]
+        self.seqs = [seq for seq, _ in live]
+        self.times = [t for _, t in live]
+        self.head = 0
+
+        for category in list(self.by_category):
+            seqs = [s for s in self.by_category[category] if s in self.by_seq]
+            if seqs:
+                self.by_category[category] = seqs
+            else:
+                del self.by_category[category]
+
+    def query(self, since=None, cursor=None, limit=100, category=None):
+        """Anomalies added or updated after cursor (a sequence number)
+        and at or after since (a UNIX timestamp), oldest first, filtered
+        by category. Without cursor and since, the latest limit ones.
+        Returns their serialized forms and the cursor to continue from.
+        """
+
+        if category is None:
+            seqs = self.seqs
+        else:
+            seqs = self.by_category.get(category, [])
+
+        items = []
+
+        if cursor is None and since is None:
+            for seq in reversed(seqs):
+                if len(items) >= limit:
+                    break
+                if seq in self.by_seq:
+                    items.append(self.by_seq[seq])
+            items.reverse()
+
+        else:
+            start = 0
+            if cursor is not None:
+                start = bisect.bisect_right(seqs, cursor)
+            if since is not None:
+                i = bisect.bisect_left(self.times, since)
+                first = self.seqs[i] if i < len(self.seqs) else self.next_seq
+                start = max(start, bisect.bisect_left(seqs, first))
+
+            for i in range(start, len(seqs)):
+                if len(items) >= limit:
+                    break
+                if seqs[i] in self.by_seq:
+                    items.append(self.by_seq[seqs[i]])
+
+        next_cursor = items[-1].seq if items else cursor
+        return [anomaly.as_dict() for anomaly in items], next_cursor
 
 
 class Bucket:
+    """Running packet length statistics per direction, in O(1) memory."""
+
+    __slots__ = ("stats",)
+
+    # Per direction: count, sum, M2 (Welford), min, max
+    FIELDS = 5
+    EMPTY = (0.0, 0.0, 0.0, math.inf, -math.inf) * 2
+
     def __init__(self):
-        self.values = [[], []]  # FWD  # REV
+        self.stats = array("d", self.EMPTY)
+
+    def as_dict(self):
+        return [
+            {
+                "count": self.get_count(d),
+                "mean": round(self.get_mean(d), 3),
+                "stdev": round(self.get_stdev(d), 3),
+                "min": self.get_min(d),
+                "max": self.get_max(d),
+            }
+            for d in (Direction.FWD.value, Direction.REV.value)
+        ]
+
+    def add(self, plen, direction, weight=1):
+        # weight > 1 stands for that many packets of which one was sampled
+        s = self.stats
+        i = direction * self.FIELDS
+
+        n = s[i]
+        delta = plen - (s[i + 1] / n if n else 0.0)
+        s[i] = n + weight
+        s[i + 1] += plen * weight
+        s[i + 2] += weight * delta * (plen - s[i + 1] / s[i])
+
+        if plen < s[i + 3]:
+            s[i + 3] = plen
+        if plen > s[i + 4]:
+            s[i + 4] = plen
+
+    def merge(self, other):
+        s, o = self.stats, other.stats
+
+        for i in (0, self.FIELDS):
+            n_a, n_b = s[i], o[i]
+            if not n_b:
+                continue
+            if not n_a:
+                s[i : i + self.FIELDS] = o[i : i + self.FIELDS]
+                continue
 
-    def add(self, plen, direction):
-        self.values[direction].append(plen)
+            # Chan et al. pairwise update of the sum of squares
+            delta = o[i + 1] / n_b - s[i + 1] / n_a
+            s[i + 2] += o[i + 2] + delta * delta * n_a * n_b / (n_a + n_b)
+            s[i] = n_a + n_b
+            s[i + 1] += o[i + 1]
+            s[i + 3] = min(s[i + 3], o[i + 3])
+            s[i + 4] = max(s[i + 4], o[i + 4])
+
+    def get_count(self, direction):
+        return int(self.stats[direction * self.FIELDS])
+
+    def get_sum(self, direction):
+        return int(self.stats[direction * self.FIELDS + 1])
+
+    def get_min(self, direction):
+        n = self.get_count(direction)
+        return int(self.stats[direction * self.FIELDS + 3]) if n else 0
+
+    def get_max(self, direction):
+        n = self.get_count(direction)
+        return int(self.stats[direction * self.FIELDS + 4]) if n else 0
 
     def get_mean(self, direction):
-        # Needs a redesign after input changed
-        # return statistics.mean(self.values[direction])
-        return 1
+        i = direction * self.FIELDS
+        return self.stats[i + 1] / self.stats[i] if self.stats[i] else 0.0
+
+    def get_stdev(self, direction):
+        # Sample standard deviation, as statistics.stdev()
+        i = direction * self.FIELDS
+        n = self.stats[i]
+        return math.sqrt(self.stats[i + 2] / (n - 1)) if n > 1 else 0.0
 
     def get_mean_stdev(self, direction):
-        mean = self.get_mean(direction)
-        stdev = statistics.stdev(self.values[direction], mean)
-        return (mean, stdev)
+        return (self.get_mean(direction), self.get_stdev(direction))
 
 
 class TimeSeries:
+    __slots__ = ("created", "time", "value", "dirbits", "buckets")
+
+    sample_size = 20  # packets kept verbatim from the start of the flow
+    bucket_tspan = 60 * 1000000000
+    max_buckets = 60  # the last bucket takes everything after that
+
     def __init__(self, t0):
         self.created = t0
 
-        self.time = []
-        self.value = []
-        self.direction = []
+        self.time = array("q")  # ns since created
+        self.value = array("I")  # packet length, IPv6 goes past 65535
+        self.dirbits = 0  # bit i holds the direction of packet i
 
-        self.bucket_tspan = 60 * 1000000000
         self.buckets = [Bucket()]
 
     def __len__(self):
-        assert len(self.time) == len(self.value) == len(self.direction)
         return len(self.time)
 
+    @property
+    def direction(self):
+        return [(self.dirbits >> i) & 1 for i in range(len(self.time))]
+
     def __str__(self):
         output = ""
         for t, v, d in zip(self.time, self.value, self.direction):
@@ -165,70 +413,144 @@ class TimeSeries:
             )
         return output.rstrip()
 
-    def add(self, t, val, direction):
+    def add(self, t, val, direction, weight=1):
         t -= self.created
 
-        if len(self) < 20:
+        n = len(self.time)
+        if n < self.sample_size:
             self.time.append(t)
             self.value.append(val)
-            self.direction.append(direction)
+            self.dirbits |= direction << n
 
-        if t > (len(self.buckets) * self.bucket_tspan):
+        if (
+            t > (len(self.buckets) * self.bucket_tspan)
+            and len(self.buckets) < self.max_buckets
+        ):
             self.buckets.append(Bucket())
 
-        self.buckets[-1].add(val, direction)
+        self.buckets[-1].add(val, direction, weight)
 
     def total_bytes(self):
-        fwd_bytes = []
-        rev_bytes = []
+        return (
+            sum(b.get_sum(Direction.FWD.value) for b in self.buckets),
+            sum(b.get_sum(Direction.REV.value) for b in self.buckets),
+        )
 
-        for d, val in zip(self.direction, self.value):
-            fwd_bytes.append(
-                val
-            ) if d == Direction.FWD.value else rev_bytes.append(val)
+    def total_packets(self):
+        return (
+            sum(b.get_count(Direction.FWD.value) for b in self.buckets),
+            sum(b.get_count(Direction.REV.value) for b in self.buckets),
+        )
 
-        # logging.debug("fwd_bytes %d, rev_bytes %d", sum(fwd_bytes), sum(rev_bytes))
-        return (sum(fwd_bytes), sum(rev_bytes))
+    def features(self):
+        fwd_bytes, rev_bytes = self.total_bytes()
+        fwd_pkts, rev_pkts = self.total_packets()
+        mean_len = (fwd_bytes + rev_bytes) / max(1, fwd_pkts + rev_pkts)
+        return (fwd_bytes, rev_bytes, fwd_pkts, rev_pkts, mean_len)
 
-    def pep(self):
-        return "".join(map(str, self.direction))
+    def pep_code(self):
+        # The pattern's direction bits under a leading 1 marking its length
+        return (1 << len(self.time)) | self.dirbits
+
+
+def pep_string(code):
+    """Packet exchange pattern of a pep_code() as a string of directions,
+    e.g. "0101"."""
+
+    return "".join(str((code >> i) & 1) for i in range(code.bit_length() - 1))
+
+
+class PEPTable:
+    """Packet exchange pattern counts, bounded to the size most frequent
+    patterns by Space-Saving. When full, a new pattern replaces the least
+    frequent one and inherits its count as error, so it is not the next
+    one evicted. "other" is the error held by the table: the part of the
+    counts not surely owed to their patterns."""
+
+    __slots__ = ("size", "counts", "errors", "other", "total")
+
+    def __init__(self, size=16):
+        self.size = size
+        self.counts = dict()  # pep_code -> count
+        self.errors = dict()  # pep_code -> count inherited on insertion
+        self.other = 0
+        self.total = 0
+
+    def __len__(self):
+        return self.total
+
+    def as_dict(self):
+        res = {
+            pep_string(code): count
+            for code, count in sorted(
+                self.counts.items(), key=lambda kv: -kv[1]
+            )
+        }
+        res["other"] = self.other
+        return res
+
+    def add(self, code):
+        self.total += 1
+
+        if code in self.counts:
+            self.counts[code] += 1
+            return
+
+        floor = 0
+        if len(self.counts) >= self.size:
+            victim = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(victim)
+            self.other -= self.errors.pop(victim)
+
+        self.counts[code] = floor + 1
+        self.errors[code] = floor
+        self.other += floor
+
+    def share(self, code):
+        # Guaranteed share, without the inherited error
+        if not self.total or code not in self.counts:
+            return 0.0
+        return (self.counts[code] - self.errors[code]) / self.total
+
+    def concentrated(self, max_other):
+        # Whether the table holds the distribution: with more common
+        # patterns than slots, most of the counts are error
+        return self.other <= max_other * self.total
 
 
 class TimeSeriesAggregator:
-    def __init__(self):
+    def __init__(self, store):
         self.samples = 0
-        # self.timeseries = []
 
-        self.fwd_totals = list()
-        self.rev_totals = list()
+        # Per flow features of the recent flows live in a FeatureStore row
+        self.store = store
+        self.row = store.add_row()
 
         self.buckets = []
-        # self.pep_dist = Counter()
-        self.peps = []  # Packet Exchange Patterns
+        self.pep_dist = PEPTable()  # Packet Exchange Patterns
 
     def __len__(self):
         return self.samples
 
     def as_dict(self):
+        history = self.store.history(self.row)
         res = {
             "samples": self.samples,
-            # "buckets": str(self.buckets),
-            "pep_dist": self.pep_distribution(),
+            "buckets": [bucket.as_dict() for bucket in self.buckets],
+            "pep_dist": self.pep_dist.as_dict(),
             "total_bytes": {
-                "fwd": str(self.fwd_totals),
-                "rev": str(self.rev_totals),
+                "fwd": str(history[:, 0].astype(int).tolist()),
+                "rev": str(history[:, 1].astype(int).tolist()),
             },
         }
         return res
 
-    def add(self, data):  # data is of type TimeSeries
-        print("*****")
-        print(
-            "lengths before: "
-            + str(len(self.buckets))
-            + " / "
-            + str(len(data.buckets))
-        )
+    def add(self, data, conn):  # data is of type TimeSeries
+        self.samples += 1
+
+        code = data.pep_code()
+        self.store.push(self.row, data.features(), code, conn)
+        self.add_pep(code)
 
         if len(self.buckets) < len(data.buckets):
             self.buckets.extend(
@@ -238,65 +560,249 @@ class TimeSeriesAggregator:
                 ]
             )
 
-        print(
-            "lengths after:  "
-            + str(len(self.buckets))
-            + " / "
-            + str(len(data.buckets))
-        )
-
-        for i, bucket in enumerate(data.buckets):
-            print(str(i) + ": " + str(bucket.get_mean(0)))
-
-        pass
+        for own, bucket in zip(self.buckets, data.buckets):
+            own.merge(bucket)
 
-    def add_total_bytes(self, bytes_tuple):
-        fwd_bytes, rev_bytes = bytes_tuple
-        self.fwd_totals.append(fwd_bytes)
-        self.rev_totals.append(rev_bytes)
+    def add_pep(self, code):
+        self.pep_dist.add(code)
 
-    def add_pep(self, pep):
-        self.peps.append(pep)
 
-    def stats_update(self):
-        pass
-
-    def pep_distribution(self):
-        return Counter(self.peps)
+class FrequencyCounter:
+    """Sliding-window count of new connections per FreqKey.
 
+    Each key keeps the times its connections were counted at in a deque.
+    These come from the update clock, not the flow records, so they are
+    appended in order and evaluation pops expired ones off the left and
+    drops keys that have gone quiet, so a pass costs O(expired + keys).
+    """
 
-class FrequencyCounter:
-    def __init__(self, ws, thresh):
+    def __init__(
+        self, ws, thresh, limits=None, category=Category.FrequentFlow
+    ):
         self.winsize = ws * 1000000000
         self.threshold = thresh
+        self.category = category
+        self.limits = dict()  # FreqKey -> (winsize, threshold) overrides
         self.counters = dict()
         self.connref = dict()
 
+        for key, (key_ws, key_thresh) in (limits or {}).items():
+            self.set_limits(key, key_ws, key_thresh)
+
     def __str__(self):
         return str(self.counters)
 
-    def add(self, conn):
+    def set_limits(self, key, ws, thresh):
+        self.limits[key] = (ws * 1000000000, thresh)
+
+    def get_limits(self, key):
+        return self.limits.get(key, (self.winsize, self.threshold))
+
+    def __contains__(self, key):
+        return key in self.counters
+
+    def add(self, conn, t, count=1):
         key = conn.get_freq_key()
-        if key not in self.counters:
-            self.counters[key] = []
+        timestamps = self.counters.get(key)
+        if timestamps is None:
+            timestamps = self.counters[key] = deque()
             self.connref[key] = conn
 
-        self.counters[key].append(conn.created_ns)
+        timestamps.extend([t] * count)
 
-    def evaluate(self):
-        now = time.time_ns()
-
-        for counter, timestamps in self.counters.items():
-            timestamps[:] = [
-                ts for ts in timestamps if ts > (now - self.winsize)
-            ]
-            if len(timestamps) > self.threshold:
-                ratio = round((len(timestamps) / self.threshold), 3)
-                yield Anomaly(
-                    category=Category.FrequentFlow,
-                    conn=self.connref[counter],
-                    score=ratio,
+    def evaluate(self, now=None):
+        if now is None:
+            now = time.time_ns()
+
+        anomalies = []
+        quiet = []
+
+        for key, timestamps in self.counters.items():
+            winsize, threshold = self.get_limits(key)
+            cutoff = now - winsize
+
+            while timestamps and timestamps[0] <= cutoff:
+                timestamps.popleft()
+
+            if not timestamps:
+                quiet.append(key)
+
+            elif len(timestamps) > threshold:
+                ratio = round((len(timestamps) / threshold), 3)
+                anomalies.append((self.category, self.connref[key], ratio))
+
+        for key in quiet:
+            del self.counters[key]
+            del self.connref[key]
+
+        return anomalies
+
+
+class SketchMonitor:
+    """Fixed-memory view of the connections opened in a window.
+
+    Tracks the rate of new connections per FreqKey (Count-Min, over the
+    current and previous window), the distinct remote addresses per
+    inbound service (HyperLogLog, for up to max_services services) and
+    the remote addresses opening the most connections (Space-Saving).
+    Memory stays bounded however many remote addresses and ports show up.
+    """
+
+    # Connections a FreqKey needs in the window before it gets exact
+    # tracking, so that a scan touching many ports once does not take up
+    # a fan-in, frequency or half-open counter for each of them
+    admit = 3
+
+    def __init__(
+        self,
+        ws,
+        fan_in_thresh,
+        talker_thresh,
+        max_services=256,
+        top_k=64,
+    ):
+        self.winsize = ws * 1000000000
+        self.fan_in_thresh = fan_in_thresh
+        self.talker_thresh = talker_thresh
+        self.max_services = max_services
+        self.window_start = None
+
+        self.rates = sketch.CountMinSketch()
+        self.prev_rates = sketch.CountMinSketch()
+        self.half_open = sketch.CountMinSketch(width=1024)
+        self.prev_half_open = sketch.CountMinSketch(width=1024)
+        self.fan_in = dict()  # FreqKey -> HyperLogLog
+        self.fan_in_overflow = sketch.HyperLogLog()
+        self.talkers = sketch.SpaceSaving(top_k)
+        self.connref = dict()  # FreqKey or remote address -> conn
+
+    def as_dict(self):
+        return {
+            "window_start": self.window_start,
+            "fan_in": {
+                str(key): hll.count() for key, hll in self.fan_in.items()
+            },
+            "fan_in_overflow": self.fan_in_overflow.count(),
+            "top_talkers": [
+                {"addr": str(addr), "conns": count, "guaranteed": guaranteed}
+                for addr, count, guaranteed in self.talkers.top(10)
+            ],
+        }
+
+    def add(self, conn):
+        """Count a new connection, returns the estimated number of
+        connections of its FreqKey over the current and previous window."""
+
+        if self.window_start is None:
+            self.window_start = conn.created_ns
+
+        key = conn.get_freq_key()
+        rate = self.rates.add(key) + self.prev_rates.estimate(key)
+
+        if conn.acl_direction == "inbound":
+            hll = self.fan_in.get(key)
+            if hll is None:
+                if rate >= self.admit and len(self.fan_in) < self.max_services:
+                    hll = self.fan_in[key] = sketch.HyperLogLog()
+                    self.connref[key] = conn
+                else:
+                    hll = self.fan_in_overflow
+            hll.add(conn.acl_addr)
+
+        self.talkers.add(conn.acl_addr)
+        self.connref.setdefault(conn.acl_addr, conn)
+        if len(self.connref) > 2 * (self.max_services + self.talkers.k):
+            self.prune_connref()
+
+        return rate
+
+    def add_half_open(self, conn):
+        """Count a TCP connection whose handshake never completed, returns
+        the estimated number of those of its FreqKey over the current and
+        previous window."""
+
+        key = conn.get_freq_key()
+        return self.half_open.add(key) + self.prev_half_open.estimate(key)
+
+    def prune_connref(self):
+        self.connref = {
+            item: conn
+            for item, conn in self.connref.items()
+            if item in self.fan_in or item in self.talkers
+        }
+
+    def evaluate(self, now=None):
+        if now is None:
+            now = time.time_ns()
+
+        anomalies = []
+
+        for key, hll in self.fan_in.items():
+            distinct = hll.count()
+            if distinct > self.fan_in_thresh:
+                anomalies.append(
+                    (
+                        Category.ServiceFanIn,
+                        self.connref[key],
+                        round(distinct / self.fan_in_thresh, 3),
+                    )
+                )
+
+        # Only what an address surely opened counts: in a flood of
+        # distinct sources every tracked count is mostly inherited error
+        for addr, count, guaranteed in self.talkers.top():
+            if count <= self.talker_thresh:
+                break
+            if guaranteed <= self.talker_thresh:
+                continue
+            anomalies.append(
+                (
+                    Category.HeavyHitter,
+                    self.connref[addr],
+                    round(guaranteed / self.talker_thresh, 3),
                 )
+            )
+
+        if self.window_start is not None:
+            if now - self.window_start >= self.winsize:
+                self.rotate(now)
+
+        return anomalies
+
+    def rotate(self, now):
+        self.rates, self.prev_rates = self.prev_rates, self.rates
+        self.rates.clear()
+        self.half_open, self.prev_half_open = (
+            self.prev_half_open,
+            self.half_open,
+        )
+        self.half_open.clear()
+        self.fan_in.clear()
+        self.fan_in_overflow.clear()
+        self.talkers.clear()
+        self.connref.clear()
+        self.window_start = now
+
+
+def parse_freq_limits(text):
+    """Parse per-FreqKey frequency limits from a JSON list of objects with
+    the FreqKey fields plus "window" (seconds) and "threshold"."""
+
+    limits = dict()
+    for item in json.loads(text):
+        key = FreqKey(
+            ip_ver=int(item["ip_ver"]),
+            direction=str(item["direction"]),
+            proto=int(item["proto"]),
+            svc_port=int(item["svc_port"]),
+        )
+        window, threshold = int(item["window"]), int(item["threshold"])
+        if window <= 0 or threshold <= 0:
+            raise ValueError(
+                "window and threshold must be positive for %s" % str(key)
+            )
+        limits[key] = (window, threshold)
+    return limits
 
 
 class AUDRecord:
@@ -304,7 +810,7 @@ class AUDRecord:
         self.aud = aud_handle
         self.last_updated = 0
         self.remote_as = None
-        self.aggregator = TimeSeriesAggregator()
+        self.aggregator = TimeSeriesAggregator(aud_handle.features)
 
     def as_dict(self):
         return {
@@ -313,45 +819,115 @@ class AUDRecord:
             "aggregator": self.aggregator.as_dict(),
         }
 
-    def process(self, connlist):
+    def process(self, connlist, now):
         for conn in connlist:
-            if self.remote_as is None:
-                # self.aud.anomalies.append(Anomaly(category=Category.NovelFlow, conn=conn))
-                ### TODO: Resolve remote AS based on acl_key.addr
-                self.remote_as = "Unresolved/FIXTHIS"
-
             if conn.new:
-                self.aud.freq_counter.add(conn)
+                self.aud.count_new_conn(conn, now)
                 conn.new = False
 
-            if conn.active():
+            if conn.active(now):
                 # Do not aggregate stats over partial flow records
                 continue
 
             # Do processing / bookkeping here
-            self.aggregator.add_total_bytes(conn.data.total_bytes())
-            self.aggregator.add_pep(conn.data.pep())
+            if conn.half_open():
+                self.aud.count_half_open(conn, now)
+            self.check_pep(conn)
+            self.aggregator.add(conn.data, conn)
 
-            self.last_updated = time.time()
+            self.last_updated = now / 1e9
 
             # Finally:
             conn.marked_for_deletion = True
 
-    def evaluate(self):
-        pass
+    def check_pep(self, conn):
+        # Flag flows whose exchange pattern is rare for this record
+        peps = self.aggregator.pep_dist
+        if len(peps) < self.aud.pep_min_samples:
+            return
+        if not peps.concentrated(self.aud.pep_max_other):
+            return
+
+        share = peps.share(conn.data.pep_code())
+        if share < self.aud.pep_min_share:
+            self.aud.pending.append(
+                (Category.PacketExchangeMimatch, conn, 1.0 - share)
+            )
+
+
+def anomaly_key(category, conn):
+    """What repeated detections of a category have in common."""
+
+    if category in (
+        Category.FrequentFlow,
+        Category.ServiceFanIn,
+        Category.HalfOpenFlood,
+    ):
+        return (category, conn.get_freq_key())
+    if category is Category.HeavyHitter:
+        return (category, conn.acl_addr)
+    return (category, conn.get_acl_key())
 
 
 class AUD:
-    def __init__(self):
+    # Closed flows a record needs before its pattern distribution is
+    # trusted, and the share below which a pattern counts as a mismatch
+    pep_min_samples = 20
+    pep_min_share = 0.01
+    # Share of the pattern counts that may be error before the table is
+    # considered too spread out to call any pattern rare
+    pep_max_other = 0.1
+
+    # An open anomaly not detected again for close_after seconds is
+    # closed; while open, updates are republished at most every
+    # republish_after seconds
+    close_after = 300
+    republish_after = 60
+
+    def __init__(
+        self,
+        freq_limits=None,
+        fan_in_thresh=100,
+        talker_thresh=100,
+        half_open_thresh=100,
+        learning=False,
+        publish=None,
+        anomaly_retention=1000,
+        resolver=None,
+        aggregate_by_as=False,
+    ):
+        # While learning, baselines are built but no anomalies raised
+        self.learning = learning
+        self.publish = publish  # called with each anomaly's DHT payload
+        # Maps remote addresses to AS numbers. With aggregate_by_as, the
+        # addresses of an AS share one record, which keeps CDN churn from
+        # creating a record per address.
+        self.resolver = resolver
+        self.aggregate_by_as = aggregate_by_as and resolver is not None
         self.global_conn_counter = 0
         self.last_updated = 0
         self.records = dict()
-        self.freq_counter = FrequencyCounter(30, 30)
-        self.anomalies = deque(maxlen=100)
+        self.freq_counter = FrequencyCounter(30, 30, freq_limits)
+        self.sketches = SketchMonitor(30, fan_in_thresh, talker_thresh)
+        self.half_open = FrequencyCounter(
+            30, half_open_thresh, category=Category.HalfOpenFlood
+        )
+        self.features = features.FeatureStore()
+        self.pending = []  # (category, conn, score) flagged during update
+        self.anomalies = AnomalyStore(
+            anomaly_retention, lambda: self.clock() / 1e9
+        )
+        self.open_anomalies = dict()  # anomaly_key() -> Anomaly
 
     def as_dict(self):
         res = {
+            "learning": self.learning,
             "global_conn_counter": str(self.global_conn_counter),
+            "sketches": self.sketches.as_dict(),
+            "features": self.features.as_dict(),
+            "resolver": self.resolver.as_dict()
+            if self.resolver is not None
+            else None,
             "aud_records": [
                 {"acl_key": str(key), "data": self.records[key].as_dict()}
                 for key in self.records.keys()
@@ -359,30 +935,129 @@ class AUD:
         }
         return res
 
+    def clock(self):
+        # Connection windows and anomaly times are measured on this,
+        # replays override it
+        return time.time_ns()
+
     def update(self, connlist):
+        now = connlist.clock()
         acl_keys = connlist.aggregate_acl_keys()
         logging.debug("Total ACL keys: %d", len(acl_keys))
         for key in acl_keys:
             # logging.debug("%s", str(key))
-            if key not in self.records:
-                self.records[key] = AUDRecord(self)
+            asn = None
+            if self.resolver is not None:
+                asn = self.resolver.lookup(key.addr)
+
+            record_key = key
+            if self.aggregate_by_as and asn is not None:
+                record_key = key._replace(addr="AS%d" % asn)
+
+            record = self.records.get(record_key)
+            if record is None:
+                record = self.records[record_key] = AUDRecord(self)
+                record.remote_as = None if asn is None else "AS%d" % asn
+
+            record.process(connlist.conns_by_acl_key(key), now)
+
+    def count_new_conn(self, conn, now):
+        rate = self.sketches.add(conn)
+        self.admit(self.freq_counter, conn, rate, now)
+
+    def count_half_open(self, conn, now):
+        # Counted when the flow expires, its creation is too long ago
+        rate = self.sketches.add_half_open(conn)
+        self.admit(self.half_open, conn, rate, now)
 
-            self.records[key].process(connlist.conns_by_acl_key(key))
+    def admit(self, counter, conn, rate, t):
+        # Exact counting for keys the sketches saw often enough
+        key = conn.get_freq_key()
+        if key in counter:
+            counter.add(conn, t=t)
+            return
+
+        _, threshold = counter.get_limits(key)
+        admit = min(self.sketches.admit, threshold)
+        if rate == admit:
+            # Backfill the connections counted before admission
+            counter.add(conn, count=admit, t=t)
+        elif rate > admit:
+            # Returning after going quiet, or a sketch collision
+            counter.add(conn, t=t)
 
     def evaluate(self):
+        # (category, conn, score) flagged during update and by detectors.
+        # All records are scored in one pass over the feature store.
+        results = self.pending
+        self.pending = []
+        results.extend(
+            (Category.TrafficDeviation, conn, score)
+            for conn, score in self.features.evaluate()
+        )
+        now = self.clock()
+        results.extend(self.freq_counter.evaluate(now))
+        results.extend(self.half_open.evaluate(now))
+        results.extend(self.sketches.evaluate(now))
+
+        if self.learning:
+            return 0
+
         count = 0
-        for record in self.records.values():
-            record.evaluate()
+        detected = set()
 
-        for result in self.freq_counter.evaluate():
-            self.anomalies.append(result)
-            count += 1
+        for category, conn, score in results:
+            key = anomaly_key(category, conn)
+            anomaly = self.open_anomalies.get(key)
 
+            if anomaly is None:
+                anomaly = Anomaly(
+                    category=category, conn=conn, score=score, now=now
+                )
+                self.open_anomalies[key] = anomaly
+                count += 1
+            else:
+                anomaly.update(score, now)
+            detected.add(key)
+
+            # Also re-adds an open anomaly that retention had dropped
+            self.anomalies.add(anomaly)
+
+        # Open anomalies never published, e.g. refused by the rate limit
+        # last time, whether or not they were detected again
+        for key, anomaly in self.open_anomalies.items():
+            if anomaly.last_published is None or (
+                key in detected
+                and now - anomaly.last_published
+                >= self.republish_after * 1000000000
+            ):
+                if not self.publish_anomaly(anomaly, now):
+                    break  # rate limited, so would the rest be
+
+        self.close_anomalies(now)
         return count
 
+    def publish_anomaly(self, anomaly, now):
+        if self.publish is not None and (
+            self.publish(anomaly.dht_payload()) is False
+        ):
+            return False
+        anomaly.last_published = now
+        return True
+
+    def close_anomalies(self, now):
+        closed = [
+            key
+            for key, anomaly in self.open_anomalies.items()
+            if now - anomaly.seen >= self.close_after * 1000000000
+        ]
+        for key in closed:
+            del self.open_anomalies[key]
+
     def mark_benign(self, input_uuid_string):
         if input_uuid_string == "all":
             self.anomalies.clear()
+            self.open_anomalies.clear()
             return "OK"
 
         try:
@@ -390,14 +1065,17 @@ class AUD:
         except ValueError as ve:
             return str(type(ve).__name__)
 
-        for anomaly in self.anomalies:
-            if needle == anomaly.uuid:
-                self.anomalies.remove(anomaly)
-                return "OK"
-        return "anomaly UUID not found"
+        anomaly = self.anomalies.remove(needle)
+        if anomaly is None:
+            return "anomaly UUID not found"
+
+        self.open_anomalies.pop(
+            anomaly_key(anomaly.category, anomaly.conn), None
+        )
+        return "OK"
 
-    def anomaly_wrapper(self):
-        return [anomaly.as_dict() for anomaly in self.anomalies]
+    def anomaly_wrapper(self, **query):
+        return self.anomalies.query(**query)[0]
 
     def anomaly_iterator(self):
         for anomaly in self.anomalies:
@@ -1,3 +1,6 @@
+import heapq
+import ipaddress
+import itertools
 import time
 from typing import NamedTuple
 
@@ -8,23 +11,106 @@ import packetreader as pr
 
 class ConnKey(NamedTuple):
     proto: int
-    src_addr: str
-    dst_addr: str
+    src_addr: bytes  # packed
+    dst_addr: bytes  # packed
     src_port: int
     dst_port: int
 
+    def __str__(self):
+        return (
+            "ConnKey(proto=%d, src_addr=%s, dst_addr=%s, "
+            "src_port=%d, dst_port=%d)"
+            % (
+                self.proto,
+                ipaddress.ip_address(self.src_addr),
+                ipaddress.ip_address(self.dst_addr),
+                self.src_port,
+                self.dst_port,
+            )
+        )
+
+
+# TCP header flags
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+# ConnEntry.tcp_state bits
+SEEN_SYN = 0x01  # initiator's SYN
+SEEN_SYNACK = 0x02  # responder's SYN-ACK
+ESTABLISHED = 0x04  # an ACK after the SYN-ACK
+SEEN_FIN = (0x08, 0x10)  # FIN, per packet direction
+SEEN_RST = 0x20
+CLOSED_BOTH = SEEN_FIN[0] | SEEN_FIN[1]
+
+# Seconds a TCP flow is kept: by default, while its handshake is
+# incomplete, and after it was closed with FIN/FIN or RST
+TCP_TIMEOUT = 600
+TCP_HANDSHAKE_TIMEOUT = 30
+TCP_LINGER = 5
+
+
+class ConnBatch:
+    """Snapshot of connections as seen at time now, e.g. exported by a
+    fanout worker. Provides the interface AUD.update() expects."""
+
+    def __init__(self, conns=(), now=0, acl_index=None):
+        self.conns = list(conns)
+        self.now = now
 
-class Flags(NamedTuple):
-    syn: bool
-    ack: bool
+        # ACLKey -> conns, handed over by ConnList or grouped here
+        self.acl_index = acl_index
+        if acl_index is None:
+            self.acl_index = dict()
+            for conn in self.conns:
+                self.acl_index.setdefault(conn.acl_key, []).append(conn)
+
+    def __len__(self):
+        return len(self.conns)
+
+    def as_dict(self):
+        res = {
+            "conns": [conn.as_dict() for conn in self.conns],
+        }
+        return res
+
+    def clock(self):
+        return self.now
+
+    def conns_by_acl_key(self, key):
+        return self.acl_index.get(key, ())
+
+    def aggregate_acl_keys(self):
+        return self.acl_index.keys()
 
 
 class ConnList:
     def __init__(self, aud_handle):
         self.ah = aud_handle
 
-        self.lookup = dict()
-        self.conns = list()
+        self.conns = dict()  # insertion ordered set of all ConnEntries
+        self.lookup = dict()  # ConnKey -> active ConnEntry
+
+        # Min-heap of (expiry, seq, conn) holding one entry per conn in
+        # lookup. Entries go stale when a conn sees more traffic and are
+        # rescheduled lazily once they come due. A conn whose timeout
+        # shrinks is pushed again, its older entry is then skipped.
+        self.expiry = []
+        self.expiry_seq = itertools.count()
+
+        # Expired conns waiting for AUD.update() to mark them
+        self.closed = []
+
+        # Conns created, updated or expired since the last export_batch(),
+        # also indexed by ACL key as they come in, for the batch
+        self.dirty = dict()
+        self.acl_index = dict()  # ACLKey -> dirty conns
+
+        # Past its first exact_packets, a flow only records 1 in
+        # 2**sample_shift packets, weighted to stand for the others
+        self.exact_packets = aud.TimeSeries.sample_size
+        self.sample_shift = 0
 
     def __len__(self):
         return len(self.conns)
@@ -35,31 +121,70 @@ class ConnList:
         }
         return res
 
+    def clock(self):
+        return time.time_ns()
+
     def trim(self):
-        for key in list(self.lookup.keys()):
-            if self.lookup[key].active():
+        now = self.clock()
+
+        while self.expiry and self.expiry[0][0] <= now:
+            _, seq, conn = heapq.heappop(self.expiry)
+            if seq != conn.scheduled:
                 continue
 
-            # conn no longer active -> delete from lookup
-            del self.lookup[key]
+            if conn.active(now) and not conn.marked_for_deletion:
+                self.schedule(conn)
+                continue
 
-        self.conns[:] = [
-            conn for conn in self.conns if not conn.marked_for_deletion
-        ]
+            # conn no longer active -> delete from lookup
+            if self.lookup.get(conn.key) is conn:
+                del self.lookup[conn.key]
+
+            if conn.marked_for_deletion:
+                self.remove(conn)
+            else:
+                self.closed.append(conn)
+                if not conn.dirty:
+                    self.mark_dirty(conn)
+
+        closed = []
+        for conn in self.closed:
+            if conn.marked_for_deletion:
+                self.remove(conn)
+            else:
+                closed.append(conn)
+        self.closed = closed
+
+    def schedule(self, conn):
+        conn.scheduled = next(self.expiry_seq)
+        heapq.heappush(self.expiry, (conn.expires(), conn.scheduled, conn))
+
+    def mark_dirty(self, conn):
+        conn.dirty = True
+        self.dirty[conn] = None
+
+        conns = self.acl_index.get(conn.acl_key)
+        if conns is None:
+            conns = self.acl_index[conn.acl_key] = []
+        conns.append(conn)
+
+    def remove(self, conn):
+        del self.conns[conn]
 
     def connkeygen(self, proto, src, dst, sport, dport):
         if sport < dport:
             src, dst = dst, src
             sport, dport = dport, sport
-        return ConnKey(proto, str(src), str(dst), sport, dport)
+        return ConnKey(proto, src, dst, sport, dport)
 
     def record(self, pkt):
         l3hdr, l4hdr = pkt
 
-        if l3hdr.src.is_loopback or l3hdr.dst.is_loopback:
+        if pr.is_loopback(l3hdr.src) or pr.is_loopback(l3hdr.dst):
             return
         elif not (
-            l3hdr.src in self.ah.local_ips or l3hdr.dst in self.ah.local_ips
+            l3hdr.src in self.ah.local_addrs
+            or l3hdr.dst in self.ah.local_addrs
         ):
             return
         elif l3hdr.src == l3hdr.dst:
@@ -72,49 +197,100 @@ class ConnList:
             sport, dport = -1, -1
 
         key = self.connkeygen(l3hdr.proto, l3hdr.src, l3hdr.dst, sport, dport)
-
-        if key not in self.lookup:
-            entry = ConnEntry(key, l3hdr, l4hdr)
-            self.conns.append(entry)
-            self.lookup[key] = self.conns[-1]
-
         direction = 0 if l3hdr.direction == 0 else 1
+        flags = getattr(l4hdr, "flags", None)  # TCP only
 
-        self.lookup[key].append(
-            direction, l3hdr.ts, l3hdr.length, (None, None)
-        )  # TODO: flags
-
-    def conns_by_acl_key(self, key):
-        return filter(lambda conn: conn.get_acl_key() == key, self.conns)
-
-    def aggregate_acl_keys(self):
-        acl_keys = set()
-
-        for conn in self.conns:
-            if conn.key.src_addr == conn.key.dst_addr:
-                continue
-            acl_keys.add(conn.get_acl_key())
+        entry = self.lookup.get(key)
 
-        return acl_keys
+        if entry is None or entry.marked_for_deletion:
+            entry = ConnEntry(key, l3hdr, l4hdr)
+            if flags is not None:
+                entry.update_tcp(direction, flags)
+            self.conns[entry] = None
+            self.lookup[key] = entry
+            self.schedule(entry)
+
+        elif flags is not None and entry.update_tcp(direction, flags):
+            # Closed, or the handshake started: due before its entry
+            self.schedule(entry)
+
+        if not entry.dirty:
+            self.mark_dirty(entry)
+
+        entry.packets += 1
+        weight = 1
+        if self.sample_shift and entry.packets > self.exact_packets:
+            weight = 1 << self.sample_shift
+            if entry.packets & (weight - 1):
+                entry.last_updated = l3hdr.ts
+                return
+
+        entry.append(direction, l3hdr.ts, l3hdr.length, weight)
+
+    def export_batch(self):
+        # Only conns that changed since the last export: idle ones have
+        # nothing new for AUD.update(). A batch that leaves the process
+        # must be serialized before release_batch().
+        for conn in self.dirty:
+            conn.dirty = False
+
+        batch = ConnBatch(self.dirty, self.clock(), self.acl_index)
+        self.dirty = dict()
+        self.acl_index = dict()
+        return batch
+
+    def release_batch(self, batch):
+        # Apply what AUD.update() does to the exported copies
+        for conn in batch.conns:
+            conn.new = False
+            if not conn.active(batch.now):
+                conn.marked_for_deletion = True
 
 
 class ConnEntry:
+    __slots__ = (
+        "key",
+        "new",
+        "acl_direction",
+        "acl_addr",
+        "local_ip",
+        "timeout",
+        "created_ns",
+        "last_updated",
+        "last_accounted",
+        "marked_for_deletion",
+        "data",
+        "category",
+        "acl_key",
+        "freq_key",
+        "dirty",
+        "packets",
+        "sampled",
+        "tcp_state",
+        "scheduled",
+    )
+
     def __init__(self, key, l3hdr, l4hdr):
         self.key = key
         self.new = True
+        self.dirty = False
+        self.packets = 0  # seen
+        self.sampled = 0  # recorded in data
+        self.tcp_state = 0
+        self.scheduled = None  # seq of the live ConnList.expiry entry
 
         if l3hdr.direction == pr.socket.PACKET_HOST:
             self.acl_direction = "inbound"  # to
-            self.acl_addr = l3hdr.src
-            self.local_ip = l3hdr.dst
+            self.acl_addr = l3hdr.src_ip
+            self.local_ip = l3hdr.dst_ip
 
         elif l3hdr.direction == pr.socket.PACKET_OUTGOING:
             self.acl_direction = "outbound"  # from
-            self.acl_addr = l3hdr.dst
-            self.local_ip = l3hdr.src
+            self.acl_addr = l3hdr.dst_ip
+            self.local_ip = l3hdr.src_ip
 
         if isinstance(l4hdr, pr.TCPHeader):
-            self.timeout = 600
+            self.timeout = TCP_TIMEOUT
         elif isinstance(l4hdr, pr.UDPHeader):
             self.timeout = 120
         elif isinstance(l4hdr, pr.ICMPHeader):
@@ -129,6 +305,20 @@ class ConnEntry:
         self.data = aud.TimeSeries(l3hdr.ts)
         self.category = aud.Category.Undefined
 
+        self.acl_key = aud.ACLKey(
+            ip_ver=self.local_ip.version,
+            direction=self.acl_direction,
+            proto=self.key.proto,
+            addr=self.acl_addr,
+            svc_port=self.key.dst_port,
+        )
+        self.freq_key = aud.FreqKey(
+            ip_ver=self.local_ip.version,
+            direction=self.acl_direction,
+            proto=self.key.proto,
+            svc_port=self.key.dst_port,
+        )
+
     def __str__(self):
         return (
             str(self.key)
@@ -147,31 +337,65 @@ class ConnEntry:
             "acl_direction": str(self.acl_direction),
             "category": str(self.category.name),
             "active": str(self.active()),
+            "sample_rate": round(self.sample_rate(), 3),
             # "marked_for_deletion": str(self.marked_for_deletion),
         }
 
-    def active(self):
-        return self.last_updated > (
-            time.time_ns() - (self.timeout * 1000000000)
-        )
+    def active(self, now=None):
+        if now is None:
+            now = time.time_ns()
+        return self.expires() > now
+
+    def expires(self):
+        return self.last_updated + self.timeout * 1000000000
 
     def get_acl_key(self):
-        return aud.ACLKey(
-            ip_ver=self.local_ip.version,
-            direction=self.acl_direction,
-            proto=self.key.proto,
-            addr=self.acl_addr,
-            svc_port=self.key.dst_port,
-        )
+        return self.acl_key
 
     def get_freq_key(self):
-        return aud.FreqKey(
-            ip_ver=self.local_ip.version,
-            direction=self.acl_direction,
-            proto=self.key.proto,
-            svc_port=self.key.dst_port,
+        return self.freq_key
+
+    def update_tcp(self, direction, flags):
+        """Advance the TCP state with the flags of a packet. Returns True
+        when that shortened the timeout."""
+
+        state = self.tcp_state
+
+        if flags & TCP_SYN:
+            state |= SEEN_SYNACK if flags & TCP_ACK else SEEN_SYN
+        elif flags & TCP_ACK and state & SEEN_SYNACK:
+            state |= ESTABLISHED
+
+        if flags & TCP_FIN:
+            state |= SEEN_FIN[direction]
+        if flags & TCP_RST:
+            state |= SEEN_RST
+
+        if state == self.tcp_state:
+            return False
+        self.tcp_state = state
+
+        if state & SEEN_RST or state & CLOSED_BOTH == CLOSED_BOTH:
+            timeout = TCP_LINGER
+        elif state & SEEN_SYN and not state & ESTABLISHED:
+            timeout = TCP_HANDSHAKE_TIMEOUT
+        else:
+            timeout = TCP_TIMEOUT
+
+        shortened = timeout < self.timeout
+        self.timeout = timeout
+        return shortened
+
+    def half_open(self):
+        # Handshake started but never completed, e.g. unanswered or reset
+        return bool(self.tcp_state & SEEN_SYN) and not (
+            self.tcp_state & ESTABLISHED
         )
 
-    def append(self, direction, t, plen, flags):
-        self.data.add(t, plen, direction)
+    def append(self, direction, t, plen, weight=1):
+        self.data.add(t, plen, direction, weight)
+        self.sampled += 1
         self.last_updated = t
+
+    def sample_rate(self):
+        return self.sampled / self.packets if self.packets else 1.0
@@ -1,18 +1,23 @@
 #!/usr/bin/python3
 import json
 import logging
+import os
 import signal
 import sys
 import threading
 import time
 import uuid
-from collections import deque
 from datetime import datetime, timezone
 
 # Local imports
+import asresolver
 import aud
 import aud_conn
+import fanout
+import ingest
 import packetreader as pr
+import publisher
+import snapshot
 from flask import Flask, request
 
 log_path = "/tmp/aud_manager.log"
@@ -34,27 +39,150 @@ class AUDManager(threading.Thread):
         self.start_t = datetime.now(timezone.utc).replace(microsecond=0)
         self.sigterm = threading.Event()
         self.local_ips = set()
+        self.local_addrs = set()  # packed form of local_ips
 
-        self.aud = aud.AUD()
+        self.publisher = publisher.DHTPublisher(
+            os.environ.get("AUD_DHT_URL", publisher.DEFAULT_DHT_URL),
+            rate_limit=int(os.environ.get("AUD_PUBLISH_RATE", 60)),
+        )
+
+        learning_period = int(os.environ.get("AUD_LEARNING_PERIOD", 0))
+        self.learning_until = time.time() + learning_period
+
+        self.aud = aud.AUD(
+            freq_limits=aud.parse_freq_limits(
+                os.environ.get("AUD_FREQ_LIMITS", "[]")
+            ),
+            fan_in_thresh=int(os.environ.get("AUD_FANIN_THRESHOLD", 100)),
+            talker_thresh=int(
+                os.environ.get("AUD_HEAVY_HITTER_THRESHOLD", 100)
+            ),
+            half_open_thresh=int(
+                os.environ.get("AUD_HALF_OPEN_THRESHOLD", 100)
+            ),
+            learning=learning_period > 0,
+            publish=self.publisher.publish,
+            anomaly_retention=int(
+                os.environ.get("AUD_ANOMALY_RETENTION", 1000)
+            ),
+            resolver=asresolver.ASResolver(os.environ["AUD_ASN_DB"])
+            if os.environ.get("AUD_ASN_DB")
+            else None,
+            aggregate_by_as=os.environ.get("AUD_RECORD_KEY", "addr") == "as",
+        )
         self.aud_update_interval = 10  # seconds
         self.connlist = aud_conn.ConnList(self)
 
-        self.raw_buf = deque()
+        # Guards connlist and aud against the ingest loop, the update
+        # timer and the REST API running concurrently
+        self.lock = threading.RLock()
+
+        self.raw_buf = ingest.IngestQueue(
+            capacity=int(os.environ.get("AUD_INGEST_CAPACITY", 65536)),
+            policy=ingest.Policy(
+                os.environ.get("AUD_INGEST_POLICY", "drop-newest")
+            ),
+            flow_hash=pr.flow_hash,
+        )
+        self.sampling = os.environ.get("AUD_SAMPLING", "off")
+        self.sampler = None
+        if self.sampling == "adaptive":
+            self.sampler = ingest.SamplingController(self.raw_buf.capacity)
 
-        self.reader = pr.PacketReader(self.raw_buf)
-        self.local_ips.add(self.reader.get_local_ip_addr())
+        self.updater = ingest.PeriodicTimer(
+            self.aud_update_interval, self.update_cycle
+        )
+        self.reader = None
+        self.fanout = None
+
+        self.snapshot_dir = os.environ.get("AUD_SNAPSHOT_DIR")
+        self.snapshotter = None
+        if self.snapshot_dir:
+            self.load_snapshot()
+            self.snapshotter = ingest.PeriodicTimer(
+                int(os.environ.get("AUD_SNAPSHOT_INTERVAL", 300)),
+                self.save_snapshot,
+            )
+
+        for ip in pr.get_local_ip_addrs():
+            self.add_local_ip(ip)
+
+        self.capture_engine = os.environ.get("AUD_CAPTURE_ENGINE", "socket")
+        snaplen = int(os.environ.get("AUD_SNAPLEN", pr.DEFAULT_SNAPLEN))
+        fanout_workers = int(os.environ.get("AUD_FANOUT_WORKERS", 0))
+
+        if fanout_workers > 0:
+            # Capture and connection tracking run in worker processes,
+            # self.connlist stays empty
+            self.fanout = fanout.FanoutCapture(
+                fanout_workers,
+                self.capture_engine,
+                snaplen,
+                self.local_addrs,
+                self.aud_update_interval,
+                self.raw_buf.capacity,
+                self.raw_buf.policy,
+                self.sampling,
+            )
+            # Forked here, while this is the only thread: the children
+            # would inherit locks other threads hold, never released
+            self.fanout.start()
+        else:
+            self.reader = pr.create_reader(
+                self.capture_engine, self.raw_buf, snaplen
+            )
+            self.reader.attach_filter(self.local_addrs)
 
         self.start()
 
+    def add_local_ip(self, ip):
+        self.local_ips.add(ip)
+        self.local_addrs.add(ip.packed)
+
     def as_dict(self):
+        with self.lock:
+            return {
+                "started": str(self.start_t),
+                "local_ips": [str(ip) for ip in self.local_ips],
+                "capture_engine": self.capture_engine,
+                "fanout": self.fanout.as_dict() if self.fanout else None,
+                "ingest": self.raw_buf.as_dict(),
+                "sampling": self.sampler.as_dict() if self.sampler else None,
+                "dht": self.publisher.as_dict(),
+                "connlist": self.connlist.as_dict(),
+                "aud": self.aud.as_dict(),
+            }
+
+    def ingest_status(self):
+        if self.fanout:
+            queues = [q for q in self.fanout.ingest if q is not None]
+        else:
+            queues = [self.raw_buf.as_dict()]
+            if self.sampler:
+                queues[0]["sampling"] = self.sampler.as_dict()
+
+        dropped = dict.fromkeys(self.raw_buf.dropped, 0)
+        for q in queues:
+            for strategy, count in q["dropped"].items():
+                dropped[strategy] += count
+
         return {
-            "started": str(self.start_t),
-            "local_ips": [str(ip) for ip in self.local_ips],
-            "connlist": self.connlist.as_dict(),
-            "aud": self.aud.as_dict(),
+            "policy": self.raw_buf.policy.value,
+            "capacity": self.raw_buf.capacity,
+            "enqueued": sum(q["enqueued"] for q in queues),
+            "dropped": dropped,
+            # Share of packets past the first ones of a flow that are
+            # analysed, the lowest one if workers differ
+            "sample_rate": min(
+                (q["sampling"]["rate"] for q in queues if q.get("sampling")),
+                default=1.0,
+            ),
         }
 
-    def status(self):
+    def status(self, query=None):
+        with self.lock:
+            anomalies, cursor = self.aud.anomalies.query(**(query or {}))
+
         topic_name = "SIFIS:AUD_Manager_Status"
         topic_uuid = uuid.uuid3(uuid.NAMESPACE_OID, topic_name)
         res = {
@@ -68,39 +196,59 @@ class AUDManager(threading.Thread):
                     "description": "aud_manager",
                 },
                 "local_ips": [str(ip) for ip in self.local_ips],
-                "anomalies": self.aud.anomaly_wrapper(),
+                "ingest": self.ingest_status(),
+                "dht": self.publisher.as_dict(),
+                "anomalies": anomalies,
+                "next_cursor": cursor,
             }
         }
         return json.dumps(res)
 
     def run(self):
         self.running = True
-        self.reader.start()
+        self.publisher.start()
+        if not self.fanout:
+            self.reader.start()
 
         logging.info("AUD manager started")
 
         # Clear buffer to avoid surge of packets at startup
         self.raw_buf.clear()
-
-        aud_update_t = time.time() + self.aud_update_interval
+        self.updater.start()
+        if self.snapshotter:
+            self.snapshotter.start()
 
         while self.running:
-            for i in range(len(self.raw_buf)):
-                self.connlist.record(self.raw_buf.popleft())
+            batch = self.raw_buf.get_batch()
+            if self.sampler:
+                self.connlist.sample_shift = self.sampler.update(len(batch))
+            if not batch:
+                continue
+
+            with self.lock:
+                for pkt in batch:
+                    self.connlist.record(pkt)
 
-            if aud_update_t < time.time():
-                self.aud_update()
-                self.aud_evaluate()
-                self.connlist.trim()
-                aud_update_t = time.time() + self.aud_update_interval
+        self.updater.stop()
+        self.updater.join()
 
-            time.sleep(0.1)
+        if self.snapshotter:
+            self.snapshotter.stop()
+            self.snapshotter.join()
+            self.save_snapshot()
 
-        self.reader.stop()
-        self.reader.join()
+        self.publisher.stop()
+        self.publisher.join(timeout=5)
+
+        if self.fanout:
+            self.fanout.stop()
+        else:
+            self.reader.stop()
+            self.reader.join()
 
     def stop(self):
         self.running = False
+        self.raw_buf.close()
         logging.info("AUD manager stopped")
 
     def terminate(self):
@@ -108,13 +256,61 @@ class AUDManager(threading.Thread):
         self.stop()
 
     def stop_learning(self, msg):
-        self.learning = False
+        with self.lock:
+            self.aud.learning = False
         logging.debug("AUD learning ended, %s", str(msg))
         return "OK\n"
 
+    def load_snapshot(self):
+        start_t = time.time()
+        state = snapshot.load_latest(self.snapshot_dir)
+        if state is None:
+            return
+
+        with self.lock:
+            if not snapshot.restore(self.aud, state):
+                return
+
+        logging.info(
+            "Restored %d AUD records from snapshot in %f seconds",
+            len(self.aud.records),
+            round((time.time() - start_t), 3),
+        )
+
+    def save_snapshot(self):
+        # Only the copy holds the lock, serializing and writing do not
+        with self.lock:
+            state = snapshot.capture(self.aud)
+
+        try:
+            name = snapshot.write(self.snapshot_dir, state)
+        except OSError as e:
+            logging.warning("Writing AUD snapshot failed: %s", str(e))
+            return
+
+        logging.debug("Wrote AUD snapshot %s", name)
+
+    def update_cycle(self):
+        if self.aud.learning and time.time() > self.learning_until:
+            self.stop_learning("learning period elapsed")
+
+        with self.lock:
+            # Expire first, so that finished flows are in this update
+            self.connlist.trim()
+            self.aud_update()
+            self.aud_evaluate()
+
     def aud_update(self):
         start_t = time.time()
-        self.aud.update(self.connlist)
+        with self.lock:
+            if self.fanout:
+                # Merge the per-worker shards received since the last update
+                for batch in self.fanout.collect():
+                    self.aud.update(batch)
+            else:
+                batch = self.connlist.export_batch()
+                self.aud.update(batch)
+                self.connlist.release_batch(batch)
         logging.debug(
             "aud_update() finished in %f seconds.",
             round((time.time() - start_t), 3),
@@ -122,13 +318,26 @@ class AUDManager(threading.Thread):
 
     def aud_evaluate(self):
         start_t = time.time()
-        res = self.aud.evaluate()
+        with self.lock:
+            res = self.aud.evaluate()
         logging.debug(
             "aud_evaluate() finished in %f seconds. %d anomalies reported",
             round((time.time() - start_t), 3),
             res,
         )
 
+    def anomaly_query(self, args):
+        """Anomaly store query from /status request arguments."""
+
+        query = {"limit": min(int(args.get("limit", 100)), 1000)}
+        if "since" in args:
+            query["since"] = float(args["since"])
+        if "cursor" in args:
+            query["cursor"] = int(args["cursor"])
+        if "category" in args:
+            query["category"] = aud.Category[args["category"]]
+        return query
+
     def response(self, res):
         return json.dumps({"response": str(res)})
 
@@ -142,7 +351,11 @@ flasklog.disabled = True
 
 @app.route("/status")
 def apicall_aud_manager_status():
-    return str(aud_manager.status())
+    try:
+        query = aud_manager.anomaly_query(request.args)
+    except (KeyError, ValueError) as e:
+        return aud_manager.response(type(e).__name__), 400
+    return str(aud_manager.status(query))
 
 
 @app.route("/log")
@@ -154,7 +367,8 @@ def apicall_aud_manager_log():
 
 @app.route("/mark-benign/<uuid>")
 def apicall_aud_manager_mark_benign(uuid):
-    res = aud_manager.aud.mark_benign(uuid)
+    with aud_manager.lock:
+        res = aud_manager.aud.mark_benign(uuid)
     return aud_manager.response(res)
 
 
@@ -173,7 +387,8 @@ def apicall_aud_dev_update():
 
 @app.route("/dev/connlist")
 def apicall_aud_dev_connlist():
-    return json.dumps(aud_manager.connlist.as_dict())
+    with aud_manager.lock:
+        return json.dumps(aud_manager.connlist.as_dict())
 
 
 @app.route("/dev/force-stop-learning")
@@ -0,0 +1,202 @@
+import ctypes
+import socket
+import struct
+from typing import NamedTuple
+
+# asm-generic/socket.h
+SO_ATTACH_FILTER = 26
+
+# linux/bpf_common.h
+BPF_LD = 0x00
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_K = 0x00
+
+# linux/filter.h, ancillary data offsets
+SKF_AD_OFF = -0x1000
+SKF_AD_PKTTYPE = 4
+
+# struct sock_filter
+SOCK_FILTER = struct.Struct("H B B I")
+
+# Ethernet frame offsets
+ETH_TYPE = 12
+IPV4_PROTO = 14 + 9
+IPV4_SRC = 14 + 12
+IPV4_DST = 14 + 16
+IPV6_NEXT = 14 + 6
+IPV6_SRC = 14 + 8
+IPV6_DST = 14 + 24
+
+# IPv6 extension headers, followed in userspace to find the L4 protocol
+IPV6_EXT_HEADERS = (0, 43, 44, 60, 51)
+
+# Addresses compared before a block gets its own accept, which keeps the
+# conditional jumps to it within their 8-bit range
+V4_BLOCK = 128  # one insn each
+V6_BLOCK = 24  # eight insns each
+
+
+class Insn(NamedTuple):
+    code: int
+    jt: object  # label name or 0
+    jf: object  # label name or 0
+    k: object  # label name for ja, else int
+
+
+class Program:
+    """Minimal classic BPF assembler with symbolic jump targets."""
+
+    def __init__(self):
+        self.insns = []
+        self.labels = dict()
+
+    def __len__(self):
+        return len(self.insns)
+
+    def label(self, name):
+        self.labels[name] = len(self.insns)
+
+    def ld_abs(self, size, offset):
+        self.insns.append(Insn(BPF_LD | size | BPF_ABS, 0, 0, offset))
+
+    def ld_pkttype(self):
+        self.ld_abs(BPF_W, (SKF_AD_OFF + SKF_AD_PKTTYPE) & 0xFFFFFFFF)
+
+    def jeq(self, k, jt, jf=0):
+        self.insns.append(Insn(BPF_JMP | BPF_JEQ | BPF_K, jt, jf, k))
+
+    def ja(self, target):
+        # Unconditional, with a 32-bit offset: reaches any label
+        self.insns.append(Insn(BPF_JMP | BPF_JA, 0, 0, target))
+
+    def ret(self, k):
+        self.insns.append(Insn(BPF_RET | BPF_K, 0, 0, k))
+
+    def resolve(self, pos, target):
+        if target == 0:
+            return 0
+
+        offset = self.labels[target] - pos - 1
+        if not 0 <= offset <= 0xFF:
+            raise ValueError("BPF jump out of range: " + str(target))
+        return offset
+
+    def assemble(self):
+        return b"".join(
+            SOCK_FILTER.pack(
+                insn.code,
+                self.resolve(pos, insn.jt),
+                self.resolve(pos, insn.jf),
+                self.labels[insn.k] - pos - 1
+                if insn.code == BPF_JMP | BPF_JA
+                else insn.k,
+            )
+            for pos, insn in enumerate(self.insns)
+        )
+
+
+def build_filter(local_addrs, protocols, snaplen=0xFFFFFFFF):
+    """Accept host/outgoing IPv4 and IPv6 frames of the given protocols to
+    or from one of local_addrs (packed addresses), truncated to snaplen.
+    IPv6 frames starting with an extension header are accepted whatever
+    their L4 protocol."""
+
+    local_v4 = sorted(
+        int.from_bytes(addr, "big") for addr in local_addrs if len(addr) == 4
+    )
+    local_v6 = sorted(addr for addr in local_addrs if len(addr) == 16)
+
+    prog = Program()
+
+    # Conditional jumps only reach 255 insns ahead: drops are local, the
+    # IPv6 section is reached with ja, and addresses are compared in
+    # blocks that each end in their own accept
+    prog.ld_pkttype()
+    prog.jeq(0, "ethertype")  # PACKET_HOST
+    prog.jeq(4, "ethertype")  # PACKET_OUTGOING
+    prog.ret(0)
+
+    prog.label("ethertype")
+    prog.ld_abs(BPF_H, ETH_TYPE)
+    prog.jeq(0x0800, "ipv4")
+    prog.jeq(0x86DD, "to_ipv6")
+    prog.ret(0)
+
+    prog.label("to_ipv6")
+    prog.ja("ipv6")
+
+    prog.label("ipv4")
+    prog.ld_abs(BPF_B, IPV4_PROTO)
+    for proto in protocols:
+        prog.jeq(proto, "ipv4_addr")
+    prog.ret(0)
+
+    prog.label("ipv4_addr")
+    for offset in (IPV4_SRC, IPV4_DST):
+        for start in range(0, len(local_v4), V4_BLOCK):
+            accept = "ipv4_accept_%d_%d" % (offset, start)
+            prog.ld_abs(BPF_W, offset)
+            for addr in local_v4[start : start + V4_BLOCK]:
+                prog.jeq(addr, accept)
+            local_accept(prog, accept, snaplen)
+    prog.ret(0)
+
+    prog.label("ipv6")
+    prog.ld_abs(BPF_B, IPV6_NEXT)
+    for proto in tuple(protocols) + IPV6_EXT_HEADERS:
+        prog.jeq(proto, "ipv6_addr")
+    prog.ret(0)
+
+    prog.label("ipv6_addr")
+    for offset in (IPV6_SRC, IPV6_DST):
+        for start in range(0, len(local_v6), V6_BLOCK):
+            accept = "ipv6_accept_%d_%d" % (offset, start)
+            for i, addr in enumerate(local_v6[start : start + V6_BLOCK]):
+                # Compare the address as four words, any mismatch moves
+                # on to the next address
+                miss = "ipv6_miss_%d_%d" % (offset, start + i)
+                for word in range(4):
+                    prog.ld_abs(BPF_W, offset + 4 * word)
+                    k = int.from_bytes(addr[4 * word : 4 * word + 4], "big")
+                    if word < 3:
+                        prog.jeq(k, 0, miss)
+                    else:
+                        prog.jeq(k, accept)
+                prog.label(miss)
+            local_accept(prog, accept, snaplen)
+    prog.ret(0)
+
+    return prog
+
+
+def local_accept(prog, name, snaplen):
+    # Accept for the block above, skipped when nothing in it matched
+    prog.ja(name + "_next")
+    prog.label(name)
+    prog.ret(snaplen)
+    prog.label(name + "_next")
+
+
+def build_snap_filter(snaplen):
+    """Accept every frame, truncated to snaplen."""
+
+    prog = Program()
+    prog.ret(snaplen)
+    return prog
+
+
+def attach_filter(sock, prog):
+    insns = prog.assemble()
+    buf = ctypes.create_string_buffer(insns, len(insns))
+
+    # struct sock_fprog
+    fprog = struct.pack("HL", len(prog), ctypes.addressof(buf))
+    # The kernel copies the program, buf only has to outlive the call
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
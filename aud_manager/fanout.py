@@ -0,0 +1,160 @@
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import time
+
+# Local imports
+import aud_conn
+import ingest
+import packetreader as pr
+
+# The manager module starts Flask on import, so workers must be forked
+# rather than spawned, and before any other thread is started.
+FORK = multiprocessing.get_context("fork")
+
+
+class FanoutWorker(FORK.Process):
+    """Capture process owning one socket of a PACKET_FANOUT group and the
+    connection table for the flows hashed to it."""
+
+    def __init__(self, index, group_id, opts, results, stop_event):
+        FORK.Process.__init__(self, daemon=True)
+        self.index = index
+        self.group_id = group_id
+        self.opts = opts
+        self.results = results
+        self.stop_event = stop_event
+
+        self.local_addrs = set(opts["local_addrs"])
+
+    def run(self):
+        # Shutdown is driven by the manager through stop_event
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        raw_buf = ingest.IngestQueue(
+            capacity=self.opts["capacity"],
+            policy=self.opts["policy"],
+            flow_hash=pr.flow_hash,
+        )
+        reader = pr.create_reader(
+            self.opts["engine"], raw_buf, self.opts["snaplen"]
+        )
+        reader.join_fanout(self.group_id)
+        reader.attach_filter(self.local_addrs)
+        connlist = aud_conn.ConnList(self)
+        sampler = None
+        if self.opts["sampling"] == "adaptive":
+            sampler = ingest.SamplingController(self.opts["capacity"])
+
+        reader.start()
+        logging.info("Fanout worker %d started", self.index)
+
+        export_t = time.time() + self.opts["interval"]
+
+        while not self.stop_event.is_set():
+            pkts = raw_buf.get_batch(timeout=0.5)
+            if sampler:
+                connlist.sample_shift = sampler.update(len(pkts))
+            for pkt in pkts:
+                connlist.record(pkt)
+
+            if export_t < time.time():
+                self.export(connlist, raw_buf, sampler)
+                export_t = time.time() + self.opts["interval"]
+
+        # Queued batches are not waited for, the manager stops reading
+        self.results.cancel_join_thread()
+        reader.stop()
+        raw_buf.close()
+        reader.join()
+
+    def export(self, connlist, raw_buf, sampler=None):
+        connlist.trim()
+        batch = connlist.export_batch()
+        stats = raw_buf.as_dict()
+        if sampler:
+            stats["sampling"] = sampler.as_dict()
+        # Pickled here, as the queue's feeder thread would only do it
+        # after release_batch() changed the conns. put() does not block,
+        # the feeder thread writes to the pipe while capture goes on.
+        data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        self.results.put((self.index, data, stats))
+        connlist.release_batch(batch)
+
+
+class FanoutCapture:
+    """Runs capture and connection tracking in a group of worker
+    processes and collects their connection batches."""
+
+    def __init__(
+        self,
+        workers,
+        engine,
+        snaplen,
+        local_addrs,
+        interval,
+        capacity,
+        policy,
+        sampling,
+    ):
+        # Its feeder thread starts on the first put(), in a worker
+        self.results = FORK.Queue()
+        self.stop_event = FORK.Event()
+        self.batches = [0] * workers
+        self.conns = [0] * workers
+        self.ingest = [None] * workers
+
+        opts = {
+            "engine": engine,
+            "snaplen": snaplen,
+            "local_addrs": local_addrs,
+            "interval": interval,
+            "capacity": capacity,
+            "policy": policy,
+            "sampling": sampling,
+        }
+        group_id = os.getpid()
+
+        self.workers = [
+            FanoutWorker(i, group_id, opts, self.results, self.stop_event)
+            for i in range(workers)
+        ]
+
+    def as_dict(self):
+        return {
+            "workers": [
+                {
+                    "pid": worker.pid,
+                    "alive": worker.is_alive(),
+                    "batches": self.batches[i],
+                    "conns": self.conns[i],
+                    "ingest": self.ingest[i],
+                }
+                for i, worker in enumerate(self.workers)
+            ],
+        }
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout=5)
+
+    def collect(self):
+        while True:
+            try:
+                index, data, ingest_stats = self.results.get_nowait()
+            except queue.Empty:
+                return
+            batch = pickle.loads(data)
+            self.batches[index] += 1
+            self.ingest[index] = ingest_stats
+            self.conns[index] += len(batch)
+            yield batch
@@ -0,0 +1,132 @@
+import numpy as np
+
+# Per completed flow, scored in log space
+FEATURES = ("fwd_bytes", "rev_bytes", "fwd_pkts", "rev_pkts", "mean_len")
+
+
+class FeatureStore:
+    """Feature history of the completed flows of every AUD record.
+
+    Each record owns a row holding its last depth flows in a ring. Flows
+    completed since the last evaluation wait in a pending list and are
+    scored against their row's history in one vectorized pass, after
+    which they are written into the rings.
+    """
+
+    def __init__(
+        self,
+        depth=32,
+        min_samples=8,
+        z_thresh=4.0,
+        min_std=0.1,
+        capacity=1024,
+    ):
+        self.depth = depth
+        self.min_samples = min_samples
+        self.z_thresh = z_thresh
+        self.min_std = min_std  # in log space, about 10 %
+
+        self.rows = 0
+        self.values = np.zeros((capacity, depth, len(FEATURES)))
+        self.peps = np.zeros((capacity, depth), dtype=np.int32)
+        self.seen = np.zeros(capacity, dtype=np.int64)  # flows per row
+
+        self.pending_rows = []
+        self.pending_values = []
+        self.pending_peps = []
+        self.pending_conns = []
+
+    def __len__(self):
+        return self.rows
+
+    def as_dict(self):
+        return {
+            "rows": self.rows,
+            "depth": self.depth,
+            "pending": len(self.pending_rows),
+            "bytes": self.values.nbytes + self.peps.nbytes + self.seen.nbytes,
+        }
+
+    def add_row(self):
+        if self.rows == len(self.seen):
+            self.grow(2 * len(self.seen))
+
+        self.rows += 1
+        return self.rows - 1
+
+    def grow(self, capacity):
+        extra = capacity - len(self.seen)
+        self.values = np.concatenate(
+            (self.values, np.zeros((extra,) + self.values.shape[1:]))
+        )
+        self.peps = np.concatenate(
+            (self.peps, np.zeros((extra, self.depth), dtype=np.int32))
+        )
+        self.seen = np.concatenate(
+            (self.seen, np.zeros(extra, dtype=np.int64))
+        )
+
+    def push(self, row, values, pep, conn):
+        self.pending_rows.append(row)
+        self.pending_values.append(values)
+        self.pending_peps.append(pep)
+        self.pending_conns.append(conn)
+
+    def history(self, row):
+        """Feature rows of the flows in row's ring, oldest first."""
+
+        seen = int(self.seen[row])
+        if seen <= self.depth:
+            return self.values[row, :seen]
+        return np.roll(self.values[row], -(seen % self.depth), axis=0)
+
+    def evaluate(self):
+        """Score the pending flows against their rows' history, returns
+        (conn, score) for the ones deviating more than z_thresh standard
+        deviations in some feature."""
+
+        if not self.pending_rows:
+            return []
+
+        rows = np.array(self.pending_rows, dtype=np.int64)
+        values = np.array(self.pending_values, dtype=np.float64)
+        peps = np.array(self.pending_peps, dtype=np.int32)
+        conns = self.pending_conns
+
+        # Baseline per distinct row, from the history before this batch
+        uniq, inv = np.unique(rows, return_inverse=True)
+        hist = np.log1p(self.values[uniq])
+        count = np.minimum(self.seen[uniq], self.depth)
+        valid = (np.arange(self.depth) < count[:, None])[..., None]
+
+        mean = (hist * valid).sum(axis=1) / np.maximum(count, 1)[:, None]
+        sqdev = ((hist - mean[:, None, :]) ** 2 * valid).sum(axis=1)
+        std = np.sqrt(sqdev / np.maximum(count - 1, 1)[:, None])
+        std = np.maximum(std, self.min_std)
+
+        z = np.abs(np.log1p(values) - mean[inv]) / std[inv]
+        score = z.max(axis=1)
+        flagged = np.nonzero(
+            (count[inv] >= self.min_samples) & (score > self.z_thresh)
+        )[0]
+
+        result = [(conns[i], float(score[i])) for i in flagged]
+
+        self.commit(rows, values, peps)
+        self.pending_rows = []
+        self.pending_values = []
+        self.pending_peps = []
+        self.pending_conns = []
+
+        return result
+
+    def commit(self, rows, values, peps):
+        # Flows of the same row go to consecutive ring slots, in order
+        order = np.argsort(rows, kind="stable")
+        rows = rows[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        slots = (self.seen[rows] + rank) % self.depth
+
+        self.values[rows, slots] = values[order]
+        self.peps[rows, slots] = peps[order]
+        np.add.at(self.seen, rows, 1)
@@ -0,0 +1,242 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from enum import Enum
+
+
+class Policy(Enum):
+    Block = "block"  # backpressure: stall the reader, the kernel drops
+    DropNewest = "drop-newest"
+    DropOldest = "drop-oldest"
+    FlowSample = "flow-sample"  # keep whole flows, shed a share of them
+
+
+# Queue depth (fraction of capacity) where flow sampling kicks in, and the
+# number of halvings of the admitted share between there and full.
+FLOW_SAMPLE_THRESHOLD = 0.5
+FLOW_SAMPLE_LEVELS = 6
+
+
+class IngestQueue:
+    """Bounded handoff between a capture thread and the consumer.
+
+    The consumer sleeps until the producer has something for it and then
+    takes everything queued as one batch.
+    """
+
+    def __init__(
+        self, capacity=65536, policy=Policy.DropNewest, flow_hash=hash
+    ):
+        self.capacity = capacity
+        self.policy = policy
+        self.flow_hash = flow_hash
+        self.sample_from = int(capacity * FLOW_SAMPLE_THRESHOLD)
+        self.sample_shift = 0  # admitting 1 in 2**sample_shift flows
+
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.waiting = False
+        self.closed = False
+
+        self.enqueued = 0
+        self.dropped = {
+            Policy.DropNewest.value: 0,
+            Policy.DropOldest.value: 0,
+            Policy.FlowSample.value: 0,
+        }
+        self.blocked = 0
+        self.batches = 0
+        self.high_watermark = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def as_dict(self):
+        return {
+            "capacity": self.capacity,
+            "policy": self.policy.value,
+            "depth": len(self.items),
+            "high_watermark": self.high_watermark,
+            "flow_sample_rate": 1 / (1 << self.sample_shift),
+            "enqueued": self.enqueued,
+            "dropped": dict(self.dropped),
+            "blocked": self.blocked,
+            "batches": self.batches,
+        }
+
+    def put(self, item):
+        with self.lock:
+            depth = len(self.items)
+
+            if self.policy is Policy.FlowSample:
+                self.update_sample_shift(depth)
+                mask = (1 << self.sample_shift) - 1
+                if self.flow_hash(item) & mask:
+                    self.dropped[Policy.FlowSample.value] += 1
+                    return False
+
+            if depth >= self.capacity:
+                if self.policy is Policy.Block:
+                    self.blocked += 1
+                    while len(self.items) >= self.capacity:
+                        if self.closed:
+                            return False
+                        self.not_full.wait()
+
+                elif self.policy is Policy.DropOldest:
+                    self.items.popleft()
+                    self.dropped[Policy.DropOldest.value] += 1
+
+                else:
+                    # Also where flow sampling lets a packet through
+                    self.dropped[self.policy.value] += 1
+                    return False
+
+            self.items.append(item)
+            self.enqueued += 1
+
+            if self.waiting:
+                self.not_empty.notify()
+
+        return True
+
+    def update_sample_shift(self, depth):
+        if depth < self.sample_from:
+            self.sample_shift = 0
+            return
+
+        # Halve the admitted share of flows in steps as the queue fills
+        self.sample_shift = 1 + (
+            (depth - self.sample_from)
+            * FLOW_SAMPLE_LEVELS
+            // max(1, self.capacity - self.sample_from)
+        )
+
+    def get_batch(self, timeout=1.0):
+        with self.lock:
+            if not self.items and not self.closed:
+                self.waiting = True
+                self.not_empty.wait(timeout)
+                self.waiting = False
+
+            batch = list(self.items)
+            self.items.clear()
+
+            if batch:
+                self.batches += 1
+                self.high_watermark = max(self.high_watermark, len(batch))
+                self.not_full.notify()
+
+        return batch
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.not_full.notify()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+
+class SamplingController:
+    """Chooses how deep flows past their first packets are analysed.
+
+    Once per interval, looks at the deepest ingest queue seen and at the
+    CPU time used by the process. Either one above its high mark halves
+    the share of packets recorded per flow; both below their low marks
+    double it again, up to recording every packet.
+    """
+
+    def __init__(
+        self,
+        capacity,
+        interval=1.0,
+        max_shift=6,
+        depth_high=0.25,
+        depth_low=0.05,
+        cpu_high=0.9,
+        cpu_low=0.6,
+    ):
+        self.capacity = capacity
+        self.interval = interval
+        self.max_shift = max_shift
+        self.depth_high = depth_high
+        self.depth_low = depth_low
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+
+        self.shift = 0
+        self.depth = 0  # deepest queue this interval
+        self.load = (0.0, 0.0)  # queue fill and CPU share, last interval
+        self.changes = 0
+        self.tick_t = time.monotonic()
+        self.cpu_t = self.cpu_time()
+
+    def as_dict(self):
+        return {
+            "rate": 1 / (1 << self.shift),
+            "queue_fill": round(self.load[0], 3),
+            "cpu": round(self.load[1], 3),
+            "changes": self.changes,
+        }
+
+    def cpu_time(self):
+        t = os.times()
+        return t.user + t.system
+
+    def update(self, depth):
+        """Feed the queue depth, returns the sample shift to use."""
+
+        self.depth = max(self.depth, depth)
+
+        now = time.monotonic()
+        if now - self.tick_t < self.interval:
+            return self.shift
+
+        cpu_t = self.cpu_time()
+        fill = self.depth / self.capacity
+        cpu = (cpu_t - self.cpu_t) / (now - self.tick_t)
+        self.load = (fill, cpu)
+        self.tick_t = now
+        self.cpu_t = cpu_t
+        self.depth = 0
+
+        shift = self.shift
+        if fill > self.depth_high or cpu > self.cpu_high:
+            shift = min(shift + 1, self.max_shift)
+        elif fill < self.depth_low and cpu < self.cpu_low:
+            shift = max(shift - 1, 0)
+
+        if shift != self.shift:
+            self.shift = shift
+            self.changes += 1
+
+        return self.shift
+
+
+class PeriodicTimer(threading.Thread):
+    """Calls callback every interval seconds until stopped."""
+
+    def __init__(self, interval, callback):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.callback = callback
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.callback()
+            except Exception:
+                # Keep the timer alive, the next tick may succeed
+                logging.exception("Periodic callback failed")
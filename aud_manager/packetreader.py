@@ -1,33 +1,128 @@
+import functools
 import ipaddress
 import logging
+import mmap
+import os
+import select
 import socket
 import struct
 import threading
 import time
 from typing import NamedTuple
 
+# Local imports
+import bpf
+
 ETH_HEADER_L = 14
 
+# L4 protocols passed by the kernel-side filter: ICMP, TCP, UDP, ICMPv6
+CAPTURE_PROTOCOLS = (0x01, 0x06, 0x11, 0x3A)
+
+# Bytes captured per frame. Covers Ethernet, an IPv4 header with options
+# or an IPv6 header with a few extension headers, and the part of the L4
+# header that is parsed; packet lengths are taken from the IP header,
+# never from the captured size.
+DEFAULT_SNAPLEN = 128
+
+# IPv6 extension headers walked to reach the L4 header: hop-by-hop,
+# routing, fragment, destination options, authentication
+IPV6_EXT_HEADERS = (0, 43, 44, 60, 51)
+IPV6_MAX_EXT_HEADERS = 8
+
+# linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+PACKET_FANOUT = 18
+PACKET_FANOUT_HASH = 0
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct("7I")
+# struct tpacket_block_desc -> struct tpacket_hdr_v1: block_status,
+# num_pkts, offset_to_first_pkt
+TPACKET_BLOCK_HDR = struct.Struct("8x I I I")
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen,
+# tp_len, tp_status, tp_mac, tp_net
+TPACKET3_HDR = struct.Struct("I I I I I I H H")
+# TPACKET_ALIGN(sizeof(struct tpacket3_hdr)) + offsetof(sll_pkttype)
+TPACKET3_PKTTYPE_OFFSET = 48 + 10
+
+# linux/netlink.h, linux/rtnetlink.h, linux/if_addr.h
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+NLMSG_HDR = struct.Struct("=I H H I I")
+IFADDRMSG = struct.Struct("=B B B B I")
+RTATTR = struct.Struct("=H H")
+
+# Header layouts, all parsed in place with unpack_from()
+ETH_HDR = struct.Struct("! 12x H")
+IPV4_HDR = struct.Struct("! B x H 4x B B 2x 4s 4s")
+IPV6_HDR = struct.Struct("! 4x H B B 16s 16s")
+IPV6_HDR_L = 40
+IPV6_EXT_HDR = struct.Struct("! B B")
+IPV6_FRAG_HDR = struct.Struct("! B x H")
+ICMP_HDR = struct.Struct("! B B")
+TCP_HDR = struct.Struct("! H H 9x B")
+UDP_HDR = struct.Struct("! H H H")
+
+IPV6_LOOPBACK = ipaddress.IPv6Address("::1").packed
+
+# Flows to the same peer share one address object
+ip_address = functools.lru_cache(maxsize=1 << 16)(ipaddress.ip_address)
+
+
+def is_loopback(addr):
+    # addr is a packed IPv4 (4 bytes) or IPv6 (16 bytes) address
+    if len(addr) == 4:
+        return addr[0] == 127
+    return addr == IPV6_LOOPBACK
+
 
 class IPv4Packet(NamedTuple):
     ts: int
     length: int
     ttl: int
     proto: int
-    src: ipaddress.IPv4Address
-    dst: ipaddress.IPv4Address
+    src: bytes  # packed address, see src_ip
+    dst: bytes  # packed address, see dst_ip
     direction: int  # AF_PACKET -> pkttype: PACKET_HOST=0, PACKET_OUTGOING=4
 
+    @property
+    def src_ip(self):
+        return ip_address(self.src)
+
+    @property
+    def dst_ip(self):
+        return ip_address(self.dst)
+
 
 class IPv6Packet(NamedTuple):
     ts: int
-    payload_len: int
-    proto: int  # next_header
+    length: int  # including the fixed header, as IPv4 total length
     hop_limit: int
-    src: ipaddress.IPv6Address
-    dst: ipaddress.IPv6Address
+    proto: int  # next header after the extension headers
+    src: bytes  # packed address, see src_ip
+    dst: bytes  # packed address, see dst_ip
     direction: int
 
+    @property
+    def src_ip(self):
+        return ip_address(self.src)
+
+    @property
+    def dst_ip(self):
+        return ip_address(self.dst)
+
 
 class ICMPHeader(NamedTuple):
     msg_type: int
@@ -37,7 +132,7 @@ class ICMPHeader(NamedTuple):
 class TCPHeader(NamedTuple):
     sport: int
     dport: int
-    flags: bytes
+    flags: int
 
 
 class UDPHeader(NamedTuple):
@@ -47,101 +142,425 @@ class UDPHeader(NamedTuple):
 
 
 class PacketReader(threading.Thread):
-    def __init__(self, buf):
+    """Capture engine reading one frame per recvfrom_into() syscall."""
+
+    def __init__(self, buf, snaplen=DEFAULT_SNAPLEN):
         threading.Thread.__init__(self)
         self.buf = buf
         self.running = True
+        self.snaplen = snaplen
         self.sock = socket.socket(
             socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003)
         )  # ETH_P_ALL
 
+        # Truncate in the kernel from the start, until attach_filter()
+        # replaces this with the full filter
+        self.attach_filter(None)
+
     def stop(self):
         self.running = False
 
-    def run(self):
-        for pkt in self.sock_reader():
-            self.buf.append(pkt)
-
-    def sock_reader(self):
-        while self.running:
-            l3hdr = l4hdr = None
+    def join_fanout(self, group_id, mode=PACKET_FANOUT_HASH):
+        # Frames are spread over all sockets of the group. The flow hash
+        # is symmetric, so both directions of a flow end up in the same
+        # socket.
+        self.sock.setsockopt(
+            SOL_PACKET, PACKET_FANOUT, (group_id & 0xFFFF) | (mode << 16)
+        )
 
-            data, addr = self.sock.recvfrom(65535)
+    def attach_filter(self, local_addrs, protocols=CAPTURE_PROTOCOLS):
+        # Let the kernel drop everything ConnList would discard anyway.
+        # The userspace checks stay in place, so failing here only
+        # costs performance.
+        prog = bpf.build_snap_filter(self.snaplen)
+        if local_addrs is not None:
+            try:
+                full = bpf.build_filter(local_addrs, protocols, self.snaplen)
+                full.assemble()
+                prog = full
+            except ValueError as e:
+                logging.warning("Could not build BPF filter: %s", str(e))
+
+        try:
+            bpf.attach_filter(self.sock, prog)
+        except OSError as e:
+            logging.warning("Could not attach BPF filter: %s", str(e))
+            return False
+
+        logging.debug("Attached BPF filter, %d instructions", len(prog))
+        return True
 
-            seek = ETH_HEADER_L
-            ethernet_header = struct.unpack("! 6s 6s 2s", data[0:seek])
-            ethertype = int.from_bytes(ethernet_header[2], "big")
+    def run(self):
+        for pkt in self.sock_reader():
+            self.buf.put(pkt)
 
-            if ethertype == 0x0800:
-                # ETHERTYPE_IPV4
-                l3hdr, hlen = self.parse_ipv4_header(addr[2], data[seek:])
+    def frame_reader(self):
+        # Single preallocated receive buffer, reused for every frame.
+        # Frames are handed out as views into it and must be parsed
+        # before the next one is requested.
+        frame_buf = bytearray(self.snaplen)
+        view = memoryview(frame_buf)
 
-            elif ethertype == 0x86DD:
-                # ETHERTYPE_IPV6
-                l3hdr, hlen = self.parse_ipv6_header(addr[2], data[seek:])
+        # With a BPF filter attached the socket may stay silent for long,
+        # time out now and then so that stop() is noticed
+        self.sock.settimeout(0.5)
 
-            if not l3hdr:
+        while self.running:
+            try:
+                nbytes, addr = self.sock.recvfrom_into(frame_buf)
+            except socket.timeout:
                 continue
+            yield view[:nbytes], addr[2], time.time_ns()
 
+    def sock_reader(self):
+        for data, pkttype, ts in self.frame_reader():
             if not (
-                l3hdr.direction == socket.PACKET_HOST
-                or l3hdr.direction == socket.PACKET_OUTGOING
+                pkttype == socket.PACKET_HOST
+                or pkttype == socket.PACKET_OUTGOING
             ):
                 continue
 
-            seek += hlen
+            try:
+                pkt = self.parse_frame(ts, pkttype, data)
+            except struct.error:
+                # Frame too short for the headers it claims to carry
+                continue
 
-            if l3hdr.proto == 0x01:  # ICMP
-                l4hdr = self.parse_icmp_header(data[seek:])
+            if pkt:
+                yield pkt
 
-            elif l3hdr.proto == 0x06:  # TCP
-                l4hdr = self.parse_tcp_header(data[seek:])
+    def parse_frame(self, ts, direction, data):
+        l3hdr = l4hdr = None
 
-            elif l3hdr.proto == 0x11:  # UDP
-                l4hdr = self.parse_udp_header(data[seek:])
+        (ethertype,) = ETH_HDR.unpack_from(data)
+        seek = ETH_HEADER_L
 
-            if not l4hdr:
-                continue
+        if ethertype == 0x0800:
+            # ETHERTYPE_IPV4
+            l3hdr, hlen = self.parse_ipv4_header(ts, direction, data, seek)
+
+        elif ethertype == 0x86DD:
+            # ETHERTYPE_IPV6
+            l3hdr, hlen = self.parse_ipv6_header(ts, direction, data, seek)
+
+        if not l3hdr:
+            return None
 
-            yield l3hdr, l4hdr
+        seek += hlen
+
+        if l3hdr.proto == 0x01 or l3hdr.proto == 0x3A:  # ICMP, ICMPv6
+            l4hdr = self.parse_icmp_header(data, seek)
+
+        elif l3hdr.proto == 0x06:  # TCP
+            l4hdr = self.parse_tcp_header(data, seek)
+
+        elif l3hdr.proto == 0x11:  # UDP
+            l4hdr = self.parse_udp_header(data, seek)
+
+        if not l4hdr:
+            return None
+
+        return l3hdr, l4hdr
 
     # Layer 3 parsers
-    def parse_ipv4_header(self, direction, data):
-        ihl = (data[0] & 0x0F) * 4
-        length, ttl, proto, src_addr, dst_addr = struct.unpack(
-            "! 2x H 4x B B 2x 4s 4s", data[:20]
+    def parse_ipv4_header(self, ts, direction, data, offset):
+        vihl, length, ttl, proto, src, dst = IPV4_HDR.unpack_from(data, offset)
+        return (
+            IPv4Packet(ts, length, ttl, proto, src, dst, direction),
+            (vihl & 0x0F) * 4,
+        )
+
+    def parse_ipv6_header(self, ts, direction, data, offset):
+        payload_len, proto, hop_limit, src, dst = IPV6_HDR.unpack_from(
+            data, offset
         )
-        src = ipaddress.ip_address(socket.inet_ntoa(src_addr))
-        dst = ipaddress.ip_address(socket.inet_ntoa(dst_addr))
+        hlen = IPV6_HDR_L
+
+        # Walk the extension headers up to the L4 header
+        for _ in range(IPV6_MAX_EXT_HEADERS):
+            if proto not in IPV6_EXT_HEADERS:
+                break
+
+            if proto == 44:  # Fragment
+                next_proto, frag = IPV6_FRAG_HDR.unpack_from(
+                    data, offset + hlen
+                )
+                if frag & 0xFFF8:
+                    # Not the first fragment, no L4 header in it
+                    return None, 0
+                ext_len = 8
+            elif proto == 51:  # Authentication, length in 4 octet units
+                next_proto, ext_len = IPV6_EXT_HDR.unpack_from(
+                    data, offset + hlen
+                )
+                ext_len = (ext_len + 2) * 4
+            else:
+                next_proto, ext_len = IPV6_EXT_HDR.unpack_from(
+                    data, offset + hlen
+                )
+                ext_len = (ext_len + 1) * 8
+
+            proto = next_proto
+            hlen += ext_len
+
+        if proto in IPV6_EXT_HEADERS:
+            # More extension headers than walked
+            return None, 0
+
         return (
-            IPv4Packet(
-                time.time_ns(), length, ttl, proto, src, dst, direction
+            IPv6Packet(
+                ts,
+                IPV6_HDR_L + payload_len,
+                hop_limit,
+                proto,
+                src,
+                dst,
+                direction,
             ),
-            ihl,
+            hlen,
         )
 
-    def parse_ipv6_header(self, direction, data):
-        # To be implemented
-        return None, 0
-
     # Layer 4 parsers
-    def parse_icmp_header(self, data):
-        msg_type, code = struct.unpack("! B B", data[:2])
-        return ICMPHeader(msg_type, code)
-
-    def parse_tcp_header(self, data):
-        sport, dport, flags = struct.unpack("! H H 9x B", data[:14])
-        return TCPHeader(sport, dport, flags)
-
-    def parse_udp_header(self, data):
-        sport, dport, length = struct.unpack("! H H H 2x", data[:8])
-        return UDPHeader(sport, dport, length)
-
-    def get_local_ip_addr(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # Might want to catch an exception in case connect and/or getsockname fails
-        s.connect(("8.8.8.8", 80))
-        ipaddr = ipaddress.ip_address(s.getsockname()[0])
-        s.close()
-        logging.debug("local IP address = %s", str(ipaddr))
-        return ipaddr
+    def parse_icmp_header(self, data, offset):
+        return ICMPHeader._make(ICMP_HDR.unpack_from(data, offset))
+
+    def parse_tcp_header(self, data, offset):
+        return TCPHeader._make(TCP_HDR.unpack_from(data, offset))
+
+    def parse_udp_header(self, data, offset):
+        return UDPHeader._make(UDP_HDR.unpack_from(data, offset))
+
+
+class RingPacketReader(PacketReader):
+    """Capture engine reading from a memory-mapped TPACKET_V3 ring.
+
+    The kernel fills whole blocks of frames which are walked in place and
+    handed back once every frame in the block has been parsed, so there
+    is neither a syscall nor a copy per packet.
+    """
+
+    def __init__(
+        self,
+        buf,
+        snaplen=DEFAULT_SNAPLEN,
+        block_size=1 << 20,
+        block_nr=16,
+        frame_size=2048,
+        block_timeout_ms=64,
+    ):
+        PacketReader.__init__(self, buf, snaplen)
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.block_timeout_ms = block_timeout_ms
+
+        try:
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.sock.setsockopt(
+                SOL_PACKET,
+                PACKET_RX_RING,
+                TPACKET_REQ3.pack(
+                    block_size,
+                    block_nr,
+                    frame_size,
+                    (block_size // frame_size) * block_nr,
+                    block_timeout_ms,
+                    0,  # sizeof_priv
+                    0,  # feature_req_word
+                ),
+            )
+            self.ring = mmap.mmap(
+                self.sock.fileno(),
+                block_size * block_nr,
+                mmap.MAP_SHARED,
+                mmap.PROT_READ | mmap.PROT_WRITE,
+            )
+        except OSError:
+            # Do not leak the socket when falling back to another engine
+            self.sock.close()
+            raise
+
+    def run(self):
+        PacketReader.run(self)
+        self.ring.close()
+        self.sock.close()
+
+    def frame_reader(self):
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN | select.POLLERR)
+        view = memoryview(self.ring)
+        block = 0
+
+        while self.running:
+            offset = block * self.block_size
+            status, _, _ = TPACKET_BLOCK_HDR.unpack_from(view, offset)
+
+            if not status & TP_STATUS_USER:
+                # Poll with a timeout so that stop() is noticed when idle
+                poller.poll(self.block_timeout_ms * 4)
+                continue
+
+            yield from self.block_reader(view, offset)
+
+            # Return the block to the kernel
+            struct.pack_into("I", view, offset + 8, TP_STATUS_KERNEL)
+            block = (block + 1) % self.block_nr
+
+        view.release()
+
+    def block_reader(self, view, offset):
+        _, num_pkts, frame = TPACKET_BLOCK_HDR.unpack_from(view, offset)
+        frame += offset
+
+        for _ in range(num_pkts):
+            (
+                next_offset,
+                sec,
+                nsec,
+                snaplen,
+                _,
+                _,
+                mac,
+                _,
+            ) = TPACKET3_HDR.unpack_from(view, frame)
+
+            yield (
+                view[frame + mac : frame + mac + snaplen],
+                view[frame + TPACKET3_PKTTYPE_OFFSET],
+                sec * 1000000000 + nsec,
+            )
+            frame += next_offset
+
+
+CAPTURE_ENGINES = {
+    "socket": PacketReader,
+    "ring": RingPacketReader,
+}
+
+
+def create_reader(engine, buf, snaplen=DEFAULT_SNAPLEN):
+    try:
+        return CAPTURE_ENGINES[engine](buf, snaplen)
+
+    except KeyError:
+        logging.error("Unknown capture engine '%s'", engine)
+
+    except OSError as e:
+        logging.error("Capture engine '%s' unavailable: %s", engine, str(e))
+
+    logging.info("Falling back to capture engine 'socket'")
+    return PacketReader(buf, snaplen)
+
+
+def nl_align(n):
+    return (n + 3) & ~3
+
+
+def netlink_addrs():
+    """All interface addresses, from an RTM_GETADDR dump."""
+
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        request = IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        header = NLMSG_HDR.pack(
+            NLMSG_HDR.size + len(request),
+            RTM_GETADDR,
+            NLM_F_REQUEST | NLM_F_DUMP,
+            1,  # seq
+            0,  # pid, the kernel
+        )
+        sock.send(header + request)
+
+        addrs = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSG_HDR.size <= len(data):
+                length, msg_type, _, _, _ = NLMSG_HDR.unpack_from(data, offset)
+                if msg_type == NLMSG_DONE:
+                    return addrs
+                if msg_type == NLMSG_ERROR:
+                    raise OSError("netlink RTM_GETADDR failed")
+                if msg_type == RTM_NEWADDR:
+                    addrs.extend(parse_ifaddr(data, offset, length))
+                offset += nl_align(length)
+    finally:
+        sock.close()
+
+
+def parse_ifaddr(data, offset, length):
+    family, _, _, _, _ = IFADDRMSG.unpack_from(data, offset + NLMSG_HDR.size)
+    attrs = dict()
+
+    pos = offset + NLMSG_HDR.size + IFADDRMSG.size
+    end = offset + length
+    while pos + RTATTR.size <= end:
+        rta_len, rta_type = RTATTR.unpack_from(data, pos)
+        if rta_len < RTATTR.size:
+            break
+        attrs[rta_type] = bytes(data[pos + RTATTR.size : pos + rta_len])
+        pos += nl_align(rta_len)
+
+    # IFA_LOCAL is the own address on point-to-point links
+    addr = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+    if addr is None or family not in (socket.AF_INET, socket.AF_INET6):
+        return []
+    return [ipaddress.ip_address(addr)]
+
+
+def proc_inet6_addrs(path="/proc/net/if_inet6"):
+    """IPv6 interface addresses, for when netlink is not available."""
+
+    addrs = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                addrs.append(ipaddress.IPv6Address(bytes.fromhex(fields[0])))
+    return addrs
+
+
+def get_local_ip_addrs():
+    """Addresses of all local interfaces, except loopback and link-local
+    ones. Needs no network access."""
+
+    try:
+        addrs = netlink_addrs()
+    except OSError as e:
+        logging.warning("Netlink address dump failed: %s", str(e))
+        addrs = []
+        if os.path.exists("/proc/net/if_inet6"):
+            addrs.extend(proc_inet6_addrs())
+        try:
+            addrs.append(get_local_ip_addr())
+        except OSError:
+            pass
+
+    addrs = [
+        addr
+        for addr in dict.fromkeys(addrs)
+        if not (addr.is_loopback or addr.is_link_local)
+    ]
+    logging.debug("local IP addresses = %s", ", ".join(map(str, addrs)))
+    return addrs
+
+
+def get_local_ip_addr():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Might want to catch an exception in case connect and/or getsockname fails
+    s.connect(("8.8.8.8", 80))
+    ipaddr = ipaddress.ip_address(s.getsockname()[0])
+    s.close()
+    logging.debug("local IP address = %s", str(ipaddr))
+    return ipaddr
+
+
+def flow_hash(pkt):
+    # Same value for both directions of a flow
+    l3hdr, l4hdr = pkt
+    return (
+        hash(l3hdr.src)
+        ^ hash(l3hdr.dst)
+        ^ getattr(l4hdr, "sport", 0)
+        ^ getattr(l4hdr, "dport", 0)
+    )
@@ -0,0 +1,294 @@
+import logging
+import socket
+import struct
+import threading
+import time
+
+# Local imports
+import packetreader as pr
+
+# Link types handled; frames are presented to parse_frame() as Ethernet
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAP_HDR = "I H H i I I I"  # magic, version, zone, sigfigs, snaplen, link
+PCAP_REC_HDR = "I I I I"  # ts_sec, ts_frac, caplen, origlen
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPT_TSRESOL = 9
+
+ETHERTYPE_IPV4 = b"\x08\x00"
+ETHERTYPE_IPV6 = b"\x86\xdd"
+
+
+def pcap_records(f):
+    """Yields (linktype, ts_ns, data) from a pcap or pcapng file object."""
+
+    head = f.read(4)
+    if len(head) < 4:
+        return
+
+    if struct.unpack("<I", head)[0] == PCAPNG_SHB:
+        yield from pcapng_records(f, head)
+        return
+
+    for endian in "<>":
+        (magic,) = struct.unpack(endian + "I", head)
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            break
+    else:
+        raise ValueError("not a pcap or pcapng file")
+
+    hdr = struct.Struct(endian + PCAP_HDR)
+    _, _, _, _, _, _, linktype = hdr.unpack(head + f.read(hdr.size - 4))
+    scale = 1 if magic == PCAP_MAGIC_NS else 1000
+    rec = struct.Struct(endian + PCAP_REC_HDR)
+
+    while True:
+        raw = f.read(rec.size)
+        if len(raw) < rec.size:
+            return
+        sec, frac, caplen, _ = rec.unpack(raw)
+        data = f.read(caplen)
+        if len(data) < caplen:
+            return
+        yield linktype, sec * 1000000000 + frac * scale, data
+
+
+def pcapng_records(f, head):
+    endian = "<"
+    interfaces = []  # (linktype, ns per timestamp unit)
+
+    while True:
+        raw = head + f.read(8 - len(head)) if head else f.read(8)
+        head = None
+        if len(raw) < 8:
+            return
+
+        block_type, length = struct.unpack(endian + "I I", raw)
+        if block_type == PCAPNG_SHB:
+            # Section header: the byte order magic decides the endianness
+            (bom,) = struct.unpack("<I", f.read(4))
+            endian = "<" if bom == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            (length,) = struct.unpack(endian + "I", raw[4:])
+            f.read(length - 12)
+            interfaces = []
+            continue
+
+        if length < 12:
+            raise ValueError("corrupt pcapng block")
+        body = f.read(length - 8)
+        if len(body) < length - 8:
+            return
+
+        if block_type == PCAPNG_IDB:
+            (linktype,) = struct.unpack_from(endian + "H", body)
+            interfaces.append((linktype, idb_tsresol(body[8:-4], endian)))
+
+        elif block_type == PCAPNG_EPB:
+            iface, ts_high, ts_low, caplen, _ = struct.unpack_from(
+                endian + "I I I I I", body
+            )
+            linktype, unit = interfaces[iface]
+            ts = ((ts_high << 32) | ts_low) * unit
+            yield linktype, int(ts), body[20 : 20 + caplen]
+
+
+def idb_tsresol(options, endian):
+    # Nanoseconds per timestamp unit, microseconds unless if_tsresol says
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(endian + "H H", options, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_TSRESOL:
+            resol = options[offset + 4]
+            if resol & 0x80:
+                return 1e9 / (1 << (resol & 0x7F))
+            if resol <= 9:
+                return 10 ** (9 - resol)  # exact, as an int
+            return 1e9 / 10**resol
+        offset += 4 + ((length + 3) & ~3)
+    return 1000
+
+
+def write_pcap(f, frames, linktype=LINKTYPE_ETHERNET, snaplen=65535):
+    """Write (ts_ns, data) frames as a nanosecond pcap file."""
+
+    f.write(
+        struct.pack(
+            "=" + PCAP_HDR, PCAP_MAGIC_NS, 2, 4, 0, 0, snaplen, linktype
+        )
+    )
+    for ts, data in frames:
+        sec, nsec = divmod(ts, 1000000000)
+        f.write(
+            struct.pack("=" + PCAP_REC_HDR, sec, nsec, len(data), len(data))
+        )
+        f.write(data)
+
+
+def as_ethernet(linktype, data):
+    if linktype == LINKTYPE_ETHERNET:
+        return data
+    if linktype == LINKTYPE_LINUX_SLL:
+        # 16 byte header ending in the protocol, where Ethernet has 14
+        return memoryview(data)[2:]
+    if linktype == LINKTYPE_RAW and data:
+        version = data[0] >> 4
+        ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6
+        return bytes(12) + ethertype + data
+    return None
+
+
+class PcapReader(pr.PacketReader):
+    """Stands in for PacketReader, reading frames from a pcap or pcapng
+    file instead of a socket.
+
+    No kernel tells a frame's direction, so it is derived from the local
+    addresses given to attach_filter(): frames from one are outgoing,
+    frames to one incoming, and others are skipped like the kernel-side
+    filter would. Timestamps are taken from the trace. With speed, frames
+    are paced to the trace timing sped up that many times, otherwise they
+    are read as fast as possible.
+    """
+
+    def __init__(self, buf, path, speed=0, snaplen=pr.DEFAULT_SNAPLEN):
+        threading.Thread.__init__(self)
+        self.buf = buf
+        self.path = path
+        self.speed = speed
+        self.snaplen = snaplen
+        self.running = True
+        self.local_addrs = set()
+
+        self.frames = 0
+        self.skipped = 0
+
+    def join_fanout(self, group_id, mode=pr.PACKET_FANOUT_HASH):
+        raise OSError("fanout needs a capture socket")
+
+    def attach_filter(self, local_addrs, protocols=pr.CAPTURE_PROTOCOLS):
+        self.local_addrs = set(local_addrs or ())
+        return True
+
+    def frame_direction(self, data):
+        ethertype = bytes(data[12:14])
+        if ethertype == ETHERTYPE_IPV4:
+            src, dst = bytes(data[26:30]), bytes(data[30:34])
+        elif ethertype == ETHERTYPE_IPV6:
+            src, dst = bytes(data[22:38]), bytes(data[38:54])
+        else:
+            return None
+
+        if src in self.local_addrs:
+            return socket.PACKET_OUTGOING
+        if dst in self.local_addrs:
+            return socket.PACKET_HOST
+        return None
+
+    def frame_reader(self):
+        start_ts = start_t = None
+
+        with open(self.path, "rb") as f:
+            for linktype, ts, data in pcap_records(f):
+                if not self.running:
+                    return
+
+                self.frames += 1
+                data = as_ethernet(linktype, data)
+                pkttype = None if data is None else self.frame_direction(data)
+                if pkttype is None:
+                    self.skipped += 1
+                    continue
+
+                if self.speed:
+                    if start_ts is None:
+                        start_ts, start_t = ts, time.monotonic()
+                    delay = (ts - start_ts) / 1e9 / self.speed - (
+                        time.monotonic() - start_t
+                    )
+                    if delay > 0:
+                        time.sleep(delay)
+
+                yield data[: self.snaplen], pkttype, ts
+
+        logging.info(
+            "Replayed %s: %d frames, %d skipped",
+            self.path,
+            self.frames,
+            self.skipped,
+        )
+
+
+class TraceClock:
+    """Clock for ConnList and AUD that follows replayed packets."""
+
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Replay:
+    """Drives a ConnList and an AUD from the packets of a reader, on trace
+    time: every update_interval seconds of it, flows are expired and the
+    AUD updated and evaluated, as AUDManager.update_cycle() does. The
+    durations of those steps are kept in seconds."""
+
+    def __init__(self, reader, connlist, aud_handle, update_interval=10):
+        self.reader = reader
+        self.connlist = connlist
+        self.aud = aud_handle
+        self.update_interval = update_interval * 1000000000
+
+        self.clock = TraceClock()
+        connlist.clock = aud_handle.clock = self.clock
+
+        self.packets = 0
+        self.peak_flows = 0
+        self.updates = []
+        self.evaluates = []
+
+    def run(self):
+        next_update = None
+
+        for pkt in self.reader.sock_reader():
+            ts = pkt[0].ts
+            if next_update is None:
+                next_update = ts + self.update_interval
+
+            while ts >= next_update:
+                self.clock.now = next_update
+                self.update_cycle()
+                next_update += self.update_interval
+
+            self.clock.now = ts
+            self.connlist.record(pkt)
+            self.packets += 1
+
+        if next_update is not None:
+            self.clock.now = next_update
+            self.update_cycle()
+
+    def update_cycle(self):
+        self.peak_flows = max(self.peak_flows, len(self.connlist))
+
+        start_t = time.perf_counter()
+        self.connlist.trim()
+        batch = self.connlist.export_batch()
+        self.aud.update(batch)
+        self.connlist.release_batch(batch)
+
+        update_t = time.perf_counter()
+        self.aud.evaluate()
+
+        self.updates.append(update_t - start_t)
+        self.evaluates.append(time.perf_counter() - update_t)
@@ -0,0 +1,196 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+# Local imports
+import websocket
+
+DEFAULT_DHT_URL = "ws://localhost:3000/ws"
+
+
+class TokenBucket:
+    """Allows rate events per second on average, in bursts of up to
+    burst events."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class DHTPublisher(threading.Thread):
+    """Posts messages to the DHT from a background thread, over one
+    persistent websocket that is reconnected with exponential backoff.
+
+    publish() never blocks: messages go to a bounded queue, and when it is
+    full the oldest queued message is dropped. The thread sends whatever
+    is queued in batches, a failed batch is retried after reconnecting.
+    With a rate limit (messages per minute), publish() drops what exceeds
+    it and returns False, so the caller can offer it again later.
+    """
+
+    def __init__(
+        self,
+        url=DEFAULT_DHT_URL,
+        capacity=1024,
+        batch_size=64,
+        timeout=5.0,
+        min_backoff=0.5,
+        max_backoff=30.0,
+        rate_limit=0,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.url = url
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.items = deque()  # (enqueued, message)
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+        self.ws = None
+        self.backoff = min_backoff
+        self.limiter = None
+        if rate_limit > 0:
+            self.limiter = TokenBucket(rate_limit / 60, rate_limit)
+
+        self.sent = 0
+        self.dropped = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.connects = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def as_dict(self):
+        return {
+            "url": self.url,
+            "connected": self.ws is not None,
+            "queued": len(self.items),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+            "connects": self.connects,
+            "latency_ms": {
+                "mean": round(1000 * self.latency_sum / self.sent, 3)
+                if self.sent
+                else 0.0,
+                "max": round(1000 * self.latency_max, 3),
+            },
+        }
+
+    def publish(self, payload):
+        if self.limiter is not None and not self.limiter.take():
+            self.rate_limited += 1
+            return False
+
+        message = json.dumps(payload)
+        with self.lock:
+            if len(self.items) >= self.capacity:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append((time.monotonic(), message))
+            self.not_empty.notify()
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            self.not_empty.notify()
+
+    def next_batch(self):
+        with self.lock:
+            if not self.items and not self.stopped.is_set():
+                self.not_empty.wait(1.0)
+
+            n = min(len(self.items), self.batch_size)
+            return [self.items.popleft() for _ in range(n)]
+
+    def requeue(self, batch):
+        # Back to the front, in order, still within capacity
+        with self.lock:
+            for item in reversed(batch):
+                if len(self.items) >= self.capacity:
+                    self.dropped += 1
+                    continue
+                self.items.appendleft(item)
+
+    def connect(self):
+        try:
+            self.ws = websocket.create_connection(
+                self.url, timeout=self.timeout
+            )
+        except Exception as e:
+            self.failures += 1
+            logging.debug(
+                "DHT connect failed: %s, retrying in %.1f s",
+                str(type(e).__name__),
+                self.backoff,
+            )
+            self.stopped.wait(self.backoff)
+            self.backoff = min(2 * self.backoff, self.max_backoff)
+            return False
+
+        self.connects += 1
+        self.backoff = self.min_backoff
+        return True
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+            self.ws = None
+
+    def send_batch(self, batch):
+        for i, (enqueued, message) in enumerate(batch):
+            try:
+                self.ws.send(message)
+            except Exception as e:
+                self.failures += 1
+                logging.debug("DHT send failed: %s", str(type(e).__name__))
+                self.close()
+                self.requeue(batch[i:])
+                return
+
+            latency = time.monotonic() - enqueued
+            self.sent += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def run(self):
+        while not self.stopped.is_set():
+            batch = self.next_batch()
+            if not batch:
+                continue
+
+            if self.ws is None and not self.connect():
+                self.requeue(batch)
+                continue
+
+            self.send_batch(batch)
+
+        # Flush what fits in one more batch if still connected
+        if self.ws is not None:
+            self.send_batch(self.next_batch())
+        self.close()
@@ -0,0 +1,163 @@
+import hashlib
+import math
+from array import array
+
+
+def digest(item, size):
+    # Stable across processes, unlike hash(), so that sketches built in
+    # different processes can be merged
+    return hashlib.blake2b(str(item).encode(), digest_size=size).digest()
+
+
+def hash64(item):
+    return int.from_bytes(digest(item, 8), "little")
+
+
+class CountMinSketch:
+    """Approximate per-item counts in width * depth counters. Estimates
+    never undercount; they overcount by at most 2N/width with probability
+    1 - 2**-depth, N being the total count."""
+
+    def __init__(self, width=8192, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.table = array("I", bytes(4 * width * depth))
+
+    def __len__(self):
+        return self.total
+
+    def cells(self, item):
+        # One 32-bit hash per row, all cut from a single digest
+        hashes = array("I", digest(item, 4 * self.depth))
+        return [
+            row * self.width + h % self.width for row, h in enumerate(hashes)
+        ]
+
+    def add(self, item, count=1):
+        # Returns the updated estimate for item
+        self.total += count
+        estimate = None
+        for cell in self.cells(item):
+            self.table[cell] += count
+            if estimate is None or self.table[cell] < estimate:
+                estimate = self.table[cell]
+        return estimate
+
+    def estimate(self, item):
+        return min(self.table[cell] for cell in self.cells(item))
+
+    def merge(self, other):
+        assert (self.width, self.depth) == (other.width, other.depth)
+        self.total += other.total
+        for i, count in enumerate(other.table):
+            self.table[i] += count
+
+    def clear(self):
+        self.total = 0
+        self.table = array("I", bytes(4 * self.width * self.depth))
+
+
+class HyperLogLog:
+    """Approximate count of distinct items in 2**p one-byte registers,
+    with a standard error of about 1.04 / sqrt(2**p)."""
+
+    def __init__(self, p=10):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, item):
+        h = hash64(item)
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def count(self):
+        estimate = (
+            self.alpha
+            * self.m
+            * self.m
+            / sum(2.0**-r for r in self.registers)
+        )
+
+        if estimate <= 2.5 * self.m:
+            # Small range correction: linear counting
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = self.m * math.log(self.m / zeros)
+
+        return int(round(estimate))
+
+    def merge(self, other):
+        assert self.p == other.p
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def clear(self):
+        self.registers = bytearray(self.m)
+
+
+class SpaceSaving:
+    """Top-k heavy hitters in k counters. Any item whose true count
+    exceeds N/k is guaranteed to be tracked; its count is overestimated
+    by at most the error recorded for it."""
+
+    def __init__(self, k=64):
+        self.k = k
+        self.counts = dict()  # item -> count
+        self.errors = dict()  # item -> overestimation bound
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, item):
+        return item in self.counts
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+
+        elif len(self.counts) < self.k:
+            self.counts[item] = count
+            self.errors[item] = 0
+
+        else:
+            # Replace the smallest counter, inheriting its count as error
+            victim = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[item] = floor + count
+            self.errors[item] = floor
+
+        return self.counts[item]
+
+    def top(self, n=None):
+        """(item, count, guaranteed) by decreasing count, guaranteed being
+        the part of the count not inherited as error."""
+
+        items = sorted(self.counts.items(), key=lambda kv: -kv[1])
+        if n:
+            items = items[:n]
+        return [
+            (item, count, count - self.errors[item]) for item, count in items
+        ]
+
+    def merge(self, other):
+        for item, count in other.counts.items():
+            if item in self.counts:
+                self.counts[item] += count
+                self.errors[item] += other.errors[item]
+            else:
+                self.counts[item] = count
+                self.errors[item] = other.errors[item]
+
+        for item, _, _ in self.top()[self.k :]:
+            del self.counts[item]
+            del self.errors[item]
+
+    def clear(self):
+        self.counts.clear()
+        self.errors.clear()
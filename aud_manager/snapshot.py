@@ -0,0 +1,200 @@
+import logging
+import os
+import pickle
+import shutil
+import time
+from array import array
+from collections import deque
+
+# Local imports
+import aud
+import numpy as np
+
+SNAPSHOT_VERSION = 3
+KEEP = 2  # snapshots kept on disk
+
+# SketchMonitor state saved, its thresholds come from the configuration
+SKETCH_STATE = (
+    "window_start",
+    "rates",
+    "prev_rates",
+    "half_open",
+    "prev_half_open",
+    "fan_in",
+    "fan_in_overflow",
+    "talkers",
+    "connref",
+)
+
+# FeatureStore arrays, saved as .npy files next to the pickled metadata
+ARRAYS = ("values", "peps", "seen")
+
+
+def capture(aud_handle):
+    """Copy the learned state of an AUD into plain data. Needs the
+    caller's lock, but only for the copy; write() can run without it."""
+
+    store = aud_handle.features
+    freq = aud_handle.freq_counter
+    sketches = aud_handle.sketches
+
+    records = []
+    for key, record in aud_handle.records.items():
+        agg = record.aggregator
+        records.append(
+            (
+                key,
+                record.last_updated,
+                record.remote_as,
+                agg.samples,
+                agg.row,
+                [bucket.stats.tobytes() for bucket in agg.buckets],
+                (
+                    dict(agg.pep_dist.counts),
+                    dict(agg.pep_dist.errors),
+                    agg.pep_dist.other,
+                ),
+            )
+        )
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "time": time.time(),
+        "learning": aud_handle.learning,
+        "global_conn_counter": aud_handle.global_conn_counter,
+        "records": records,
+        "freq_counters": {
+            key: list(timestamps) for key, timestamps in freq.counters.items()
+        },
+        # Connections are live objects, serialize them while locked
+        "freq_connref": pickle.dumps(freq.connref),
+        "sketches": pickle.dumps(
+            {name: getattr(sketches, name) for name in SKETCH_STATE}
+        ),
+    }
+
+    arrays = {
+        name: getattr(store, name)[: store.rows].copy() for name in ARRAYS
+    }
+
+    return meta, arrays
+
+
+def write(directory, state):
+    """Write a captured state as a new snapshot directory, atomically."""
+
+    meta, arrays = state
+    name = "snapshot-%d" % time.time_ns()
+    tmp = os.path.join(directory, "." + name)
+    os.makedirs(tmp)
+
+    with open(os.path.join(tmp, "meta.pickle"), "wb") as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    for key, arr in arrays.items():
+        np.save(os.path.join(tmp, key + ".npy"), arr)
+
+    os.rename(tmp, os.path.join(directory, name))
+
+    for old in list_snapshots(directory)[:-KEEP]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+
+    return name
+
+
+def list_snapshots(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if name.startswith("snapshot-"))
+
+
+def load_latest(directory):
+    """Return the state in the newest readable snapshot, or None. The
+    arrays are memory-mapped copy-on-write, so loading is not bound by
+    their size."""
+
+    for name in reversed(list_snapshots(directory)):
+        path = os.path.join(directory, name)
+        try:
+            with open(os.path.join(path, "meta.pickle"), "rb") as f:
+                meta = pickle.load(f)
+            if meta.get("version") != SNAPSHOT_VERSION:
+                logging.warning("Ignoring snapshot %s: version", name)
+                continue
+
+            arrays = {
+                key: np.load(os.path.join(path, key + ".npy"), mmap_mode="c")
+                for key in ARRAYS
+            }
+            return meta, arrays
+
+        except Exception as e:
+            logging.warning(
+                "Ignoring snapshot %s: %s", name, str(type(e).__name__)
+            )
+
+    return None
+
+
+def restore(aud_handle, state):
+    meta, arrays = state
+    store = aud_handle.features
+
+    if arrays["values"].shape[1:] != store.values.shape[1:]:
+        logging.warning("Ignoring snapshot: feature layout changed")
+        return False
+
+    # Rows are handed out in record creation order, which the records
+    # dict preserves, so re-creating the records reassigns the same rows
+    rows = [record[4] for record in meta["records"]]
+    if rows != list(range(len(rows))) or len(rows) > len(arrays["seen"]):
+        logging.warning("Ignoring snapshot: records do not match rows")
+        return False
+
+    store.rows = 0
+    for key in ARRAYS:
+        setattr(store, key, arrays[key])
+    if len(store.seen) == 0:
+        store.grow(1024)
+
+    aud_handle.records.clear()
+    for (
+        key,
+        last_updated,
+        remote_as,
+        samples,
+        _,
+        buckets,
+        (pep_counts, pep_errors, pep_other),
+    ) in meta["records"]:
+        record = aud_handle.records[key] = aud.AUDRecord(aud_handle)
+        record.last_updated = last_updated
+        record.remote_as = remote_as
+
+        agg = record.aggregator
+        agg.samples = samples
+        agg.buckets = []
+        for stats in buckets:
+            bucket = aud.Bucket()
+            bucket.stats = array("d", stats)
+            agg.buckets.append(bucket)
+
+        agg.pep_dist.counts = pep_counts
+        agg.pep_dist.errors = pep_errors
+        agg.pep_dist.other = pep_other
+        agg.pep_dist.total = sum(pep_counts.values())
+
+    freq = aud_handle.freq_counter
+    freq.counters = {
+        key: deque(timestamps)
+        for key, timestamps in meta["freq_counters"].items()
+    }
+    freq.connref = pickle.loads(meta["freq_connref"])
+
+    for name, value in pickle.loads(meta["sketches"]).items():
+        setattr(aud_handle.sketches, name, value)
+
+    aud_handle.global_conn_counter = meta["global_conn_counter"]
+    aud_handle.learning = meta["learning"]
+    return True
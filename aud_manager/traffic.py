@@ -0,0 +1,102 @@
+"""Synthetic frames and connection tables, shared by the tests and the
+benchmark tools."""
+import ipaddress
+import socket
+import struct
+
+# Local imports
+import aud_conn
+import packetreader as pr
+
+LOCAL_IP = ipaddress.ip_address("192.0.2.2")
+T0 = 1_700_000_000 * 1000000000
+
+SYN, SYNACK, ACK, FIN, RST = 0x02, 0x12, 0x10, 0x11, 0x14
+
+
+class Host:
+    """Stands in for AUDManager where a ConnList wants the local
+    addresses."""
+
+    def __init__(self, local_ips=(LOCAL_IP,)):
+        self.local_ips = set(local_ips)
+        self.local_addrs = {ip.packed for ip in self.local_ips}
+
+
+def tcp_frame(src, dst, sport, dport, flags, payload=0):
+    """Ethernet frame of an IPv4 TCP segment, addresses as strings or
+    ipaddress objects."""
+
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, 0, 0, 0x50, flags, 0, 0, 0)
+    ip = struct.pack(
+        "!BBHHHBBH4s4s",
+        0x45,
+        0,
+        40 + payload,
+        0,
+        0,
+        64,
+        6,
+        0,
+        ipaddress.ip_address(src).packed,
+        ipaddress.ip_address(dst).packed,
+    )
+    return bytes(12) + b"\x08\x00" + ip + tcp
+
+
+def tcp6_frame(src, dst, sport, dport, flags):
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, 0, 0, 0x50, flags, 0, 0, 0)
+    ip = struct.pack(
+        "!IHBB16s16s",
+        0x60000000,
+        len(tcp),
+        6,
+        64,
+        ipaddress.ip_address(src).packed,
+        ipaddress.ip_address(dst).packed,
+    )
+    return bytes(12) + b"\x86\xdd" + ip + tcp
+
+
+def handshake(remote, sport, t, close=FIN):
+    """(ts, frame) of a TCP connection from remote to LOCAL_IP:443, a
+    millisecond apart."""
+
+    local = str(LOCAL_IP)
+    frames = [
+        (remote, local, sport, 443, SYN),
+        (local, remote, 443, sport, SYNACK),
+        (remote, local, sport, 443, ACK),
+        (remote, local, sport, 443, close),
+    ]
+    if close == FIN:
+        frames.append((local, remote, 443, sport, FIN))
+    return [
+        (t + n * 1000000, tcp_frame(*frame)) for n, frame in enumerate(frames)
+    ]
+
+
+def parse(frame, t=T0, direction=socket.PACKET_HOST):
+    """Parse a frame as the capture would, without a socket."""
+
+    reader = object.__new__(pr.PacketReader)
+    return reader.parse_frame(t, direction, frame)
+
+
+def conn_list(host=None):
+    return aud_conn.ConnList(host or Host())
+
+
+def record(connlist, frame, t=T0, direction=None):
+    """Record a frame in a ConnList, by default incoming unless sent from
+    one of its local addresses."""
+
+    if direction is None:
+        if frame[12:14] == b"\x08\x00":
+            src = bytes(frame[26:30])
+        else:
+            src = bytes(frame[22:38])
+        direction = socket.PACKET_HOST
+        if src in connlist.ah.local_addrs:
+            direction = socket.PACKET_OUTGOING
+    connlist.record(parse(frame, t, direction))
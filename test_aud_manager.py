@@ -1,2 +1,1032 @@
+import ipaddress
+import os
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "aud_manager")
+)
+
+# Local imports
+import asresolver  # noqa: E402
+import aud  # noqa: E402
+import aud_conn  # noqa: E402
+import bpf  # noqa: E402
+import fanout  # noqa: E402
+import features  # noqa: E402
+import ingest  # noqa: E402
+import packetreader as pr  # noqa: E402
+import pcapreader  # noqa: E402
+import publisher  # noqa: E402
+import snapshot  # noqa: E402
+import traffic  # noqa: E402
+from traffic import (  # noqa: E402
+    ACK,
+    LOCAL_IP,
+    RST,
+    SYN,
+    SYNACK,
+    T0,
+    handshake,
+    record,
+    tcp6_frame,
+    tcp_frame,
+)
+
+
+def run_filter(prog, frame, pkttype=socket.PACKET_HOST):
+    """Run an assembled classic BPF program on a frame, returns what the
+    kernel would: the number of bytes to keep."""
+
+    code = prog.assemble()
+    insns = [
+        bpf.SOCK_FILTER.unpack_from(code, i)
+        for i in range(0, len(code), bpf.SOCK_FILTER.size)
+    ]
+    sizes = {bpf.BPF_W: "!I", bpf.BPF_H: "!H", bpf.BPF_B: "!B"}
+    acc = pc = 0
+    while True:
+        op, jt, jf, k = insns[pc]
+        pc += 1
+        if op & 0x07 == bpf.BPF_LD:
+            if k == (bpf.SKF_AD_OFF + bpf.SKF_AD_PKTTYPE) & 0xFFFFFFFF:
+                acc = pkttype
+            else:
+                (acc,) = struct.unpack_from(sizes[op & 0x18], frame, k)
+        elif op == bpf.BPF_JMP | bpf.BPF_JA:
+            pc += k
+        elif op == bpf.BPF_JMP | bpf.BPF_JEQ | bpf.BPF_K:
+            pc += jt if acc == k else jf
+        elif op == bpf.BPF_RET | bpf.BPF_K:
+            return k
+
+
+def write_trace(tmp_path, frames):
+    path = str(tmp_path / "trace.pcap")
+    with open(path, "wb") as f:
+        pcapreader.write_pcap(f, frames)
+    return path
+
+
+def replay(path, **aud_args):
+    reader = pcapreader.PcapReader(None, path)
+    connlist = traffic.conn_list()
+    reader.attach_filter(connlist.ah.local_addrs)
+    run = pcapreader.Replay(reader, connlist, aud.AUD(**aud_args))
+    run.run()
+    return run
+
+
 def test_aud_manager():
     assert True == True
+
+
+def test_bpf_filter_many_ipv4_addrs():
+    local_v4 = [ipaddress.ip_address(0x0A000001 + n) for n in range(300)]
+    addrs = [addr.packed for addr in local_v4]
+    prog = bpf.build_filter(addrs, (6, 17), 96)
+    assert len(prog.assemble()) > 256 * bpf.SOCK_FILTER.size
+
+    remote = "198.51.100.1"
+    for local in (local_v4[0], local_v4[150], local_v4[-1]):
+        inbound = tcp_frame(remote, str(local), 5000, 443, SYN)
+        outbound = tcp_frame(str(local), remote, 443, 5000, ACK)
+        # Accepted frames are cut to the snap length
+        assert run_filter(prog, inbound) == 96
+        assert run_filter(prog, outbound, socket.PACKET_OUTGOING) == 96
+
+    frame = tcp_frame(remote, "10.0.2.1", 5000, 443, SYN)
+    assert run_filter(prog, frame) == 0
+    frame = tcp_frame(remote, str(local_v4[0]), 5000, 443, SYN)
+    assert run_filter(prog, frame, socket.PACKET_BROADCAST) == 0
+    udp_only = bpf.build_filter(addrs, (17,), 96)
+    assert run_filter(udp_only, frame) == 0
+
+    assert run_filter(bpf.build_snap_filter(96), frame) == 96
+
+
+def test_bpf_filter_many_ipv6_addrs():
+    local_v6 = [
+        ipaddress.ip_address("2001:db8::%x" % (n + 1)) for n in range(40)
+    ]
+    addrs = [LOCAL_IP.packed] + [addr.packed for addr in local_v6]
+    prog = bpf.build_filter(addrs, (6, 17), 128)
+
+    remote = "2001:db8:ffff::1"
+    for local in (local_v6[0], local_v6[17], local_v6[-1]):
+        inbound = tcp6_frame(remote, local, 5000, 443, SYN)
+        outbound = tcp6_frame(local, remote, 443, 5000, ACK)
+        assert run_filter(prog, inbound) == 128
+        assert run_filter(prog, outbound, socket.PACKET_OUTGOING) == 128
+
+    assert run_filter(prog, tcp6_frame(remote, remote, 1, 2, SYN)) == 0
+    frame = tcp_frame("198.51.100.1", str(LOCAL_IP), 5000, 443, SYN)
+    assert run_filter(prog, frame) == 128
+
+
+def test_ipv6_extension_headers():
+    def frame(count):
+        # count destination options headers between IPv6 and TCP
+        base = tcp6_frame("2001:db8::1", "2001:db8::2", 5000, 443, SYN)
+        ip, tcp = bytearray(base[14:54]), base[54:]
+        ip[6] = 60
+        ext = b"".join(
+            bytes([60 if n < count - 1 else 6, 0]) + bytes(6)
+            for n in range(count)
+        )
+        struct.pack_into("!H", ip, 4, len(ext) + len(tcp))
+        return base[:14] + bytes(ip) + ext + tcp
+
+    l3hdr, l4hdr = traffic.parse(frame(8))
+    assert l3hdr.proto == 6
+    assert (l4hdr.sport, l4hdr.dport) == (5000, 443)
+    assert traffic.parse(frame(9)) is None
+
+
+def test_ring_setup_failure_closes_socket(monkeypatch):
+    class FakeSocket:
+        closed = False
+
+        def __init__(self, *args):
+            pass
+
+        def setsockopt(self, level, option, value):
+            if option == pr.PACKET_RX_RING:
+                raise OSError(12, "Cannot allocate memory")
+
+        def close(self):
+            self.closed = True
+
+    sockets = []
+    monkeypatch.setattr(
+        pr.socket,
+        "socket",
+        lambda *args: sockets.append(FakeSocket()) or sockets[-1],
+    )
+
+    with pytest.raises(OSError):
+        pr.RingPacketReader(None)
+    assert sockets[0].closed
+
+
+def test_ipv6_max_payload_length():
+    # Payload length 65535 plus the fixed header does not fit 16 bits
+    frame = bytearray(tcp6_frame("2001:db8::1", "2001:db8::2", 1, 443, SYN))
+    struct.pack_into("!H", frame, 18, 0xFFFF)
+    pkt = traffic.parse(bytes(frame))
+    assert pkt[0].length == 40 + 0xFFFF
+
+    host = traffic.Host([ipaddress.ip_address("2001:db8::2")])
+    connlist = traffic.conn_list(host)
+    connlist.record(pkt)
+    (conn,) = connlist.conns
+    assert conn.data.total_bytes() == (40 + 0xFFFF, 0)
+
+
+def test_heavy_hitter_spoofed_flood():
+    # 10000 sources opening one connection each, one opening 300
+    frames = []
+    for n in range(10000):
+        remote = ipaddress.ip_address(0x0A000000 + n)
+        frames.append(tcp_frame(remote, str(LOCAL_IP), 1024, 443, SYN))
+        if n % 33 == 0:
+            frames.append(
+                tcp_frame("203.0.113.7", str(LOCAL_IP), 1024 + n, 443, SYN)
+            )
+
+    connlist = traffic.conn_list()
+    for frame in frames:
+        record(connlist, frame)
+
+    sketches = aud.SketchMonitor(30, 100, 100)
+    for conn in connlist.conns:
+        sketches.add(conn)
+
+    hitters = [
+        str(conn.acl_addr)
+        for category, conn, _ in sketches.evaluate(T0)
+        if category is aud.Category.HeavyHitter
+    ]
+    assert hitters == ["203.0.113.7"]
+
+
+def pep_mismatches(codes):
+    # Flows flagged by check_pep when closed in this order
+    handle = aud.AUD()
+    record = aud.AUDRecord(handle)
+    flagged = []
+    for code in codes:
+        data = types.SimpleNamespace(pep_code=lambda code=code: code)
+        record.check_pep(types.SimpleNamespace(data=data))
+        flagged += [code for _ in handle.pending]
+        handle.pending = []
+        record.aggregator.add_pep(code)
+    return flagged
+
+
+def test_pep_mismatch():
+    # 40 equally common patterns do not fit the 16 slots, none is rare
+    assert len(pep_mismatches([100 + n % 40 for n in range(2000)])) < 20
+
+    # Three common patterns and a rare one every 50 flows
+    codes = [1000 + n if n % 50 == 49 else n % 3 for n in range(5000)]
+    assert pep_mismatches(codes) == [1000 + n for n in range(49, 5000, 50)]
+
+
+def test_frequency_counter_in_order():
+    # Flows are counted in update order, not in creation order
+    connlist = traffic.conn_list()
+    for n in range(5):
+        frame = tcp_frame("203.0.113.7", str(LOCAL_IP), 1024 + n, 443, SYN)
+        t = T0 - n * 1000000000
+        record(connlist, frame, t)
+
+    handle = aud.AUD()
+    counted = [T0 + n * 1000000000 for n in range(5)]
+    for conn, now in zip(connlist.conns, counted):
+        handle.count_new_conn(conn, now)
+
+    (timestamps,) = handle.freq_counter.counters.values()
+    assert list(timestamps) == sorted(timestamps)
+    assert timestamps[-1] == counted[-1]
+
+
+def test_expiry_rescheduled():
+    connlist = traffic.conn_list()
+    frame = tcp_frame("198.51.100.1", str(LOCAL_IP), 5000, 443, ACK)
+    second = 1000000000
+    for t in (T0, T0 + 500 * second):
+        record(connlist, frame, t)
+    (conn,) = connlist.conns
+    assert conn.timeout == aud_conn.TCP_TIMEOUT
+
+    # The heap entry from the first packet comes due, the flow is not
+    connlist.clock = lambda: T0 + 601 * second
+    connlist.trim()
+    assert connlist.closed == []
+    assert connlist.lookup == {conn.key: conn}
+    assert len(connlist.expiry) == 1
+
+    connlist.clock = lambda: T0 + 1101 * second
+    connlist.trim()
+    assert connlist.closed == [conn]
+    assert connlist.lookup == {}
+
+
+def test_export_changed_conns():
+    connlist = traffic.conn_list()
+    second = 1000000000
+    connlist.clock = lambda: T0 + second
+
+    def packet(remote, t):
+        frame = tcp_frame(remote, str(LOCAL_IP), 5000, 443, ACK)
+        record(connlist, frame, t)
+
+    def export():
+        batch = connlist.export_batch()
+        connlist.release_batch(batch)
+        assert connlist.dirty == {}
+        assert not any(conn.dirty for conn in connlist.conns)
+        return batch.conns
+
+    packet("198.51.100.1", T0)
+    packet("198.51.100.2", T0)
+    first, second_conn = connlist.conns
+    assert export() == [first, second_conn]
+
+    # Only what saw traffic since, then what expired since
+    packet("198.51.100.1", T0 + second)
+    assert export() == [first]
+    connlist.clock = lambda: T0 + 600 * second + second // 2
+    connlist.trim()
+    assert export() == [second_conn]
+    assert second_conn.marked_for_deletion
+    assert export() == []
+
+
+def test_acl_index():
+    connlist = traffic.conn_list()
+    for remote, sport in (("198.51.100.1", 5000), ("198.51.100.2", 5000)):
+        for n in range(2):
+            frame = tcp_frame(remote, str(LOCAL_IP), sport + n, 443, SYN)
+            record(connlist, frame)
+    conns = list(connlist.conns)
+
+    # Indexed as they are recorded, then handed over with the batch
+    batch = connlist.export_batch()
+    assert [
+        list(batch.conns_by_acl_key(key)) for key in batch.aggregate_acl_keys()
+    ] == [
+        conns[:2],
+        conns[2:],
+    ]
+    assert connlist.acl_index == {}
+
+    frame = tcp_frame(str(LOCAL_IP), "198.51.100.2", 443, 5001, SYNACK)
+    record(connlist, frame)
+    assert connlist.acl_index == {conns[3].acl_key: [conns[3]]}
+
+
+def test_parse_freq_limits():
+    item = '{"ip_ver": 4, "direction": "outbound", "proto": 17, '
+    item += '"svc_port": 53, "window": %d, "threshold": %d}'
+    key = aud.FreqKey(4, "outbound", 17, 53)
+    assert aud.parse_freq_limits("[%s]" % (item % (30, 200))) == {
+        key: (30, 200)
+    }
+
+    for window, threshold in ((30, 0), (0, 200), (30, -1)):
+        with pytest.raises(ValueError, match="svc_port=53"):
+            aud.parse_freq_limits("[%s]" % (item % (window, threshold)))
+
+
+def test_rate_limited_publish_retried():
+    connlist = traffic.conn_list()
+    frame = tcp_frame("203.0.113.7", str(LOCAL_IP), 1024, 443, SYN)
+    record(connlist, frame)
+    (conn,) = connlist.conns
+
+    def run(detections, accepted):
+        published = []
+
+        def publish(payload):
+            published.append(payload)
+            return accepted.pop(0)
+
+        handle = aud.AUD(publish=publish)
+        for detected in detections:
+            if detected:
+                handle.pending = [(aud.Category.HeavyHitter, conn, 2.0)]
+            handle.evaluate()
+
+        (anomaly,) = handle.open_anomalies.values()
+        assert anomaly.last_published is not None
+        return len(published)
+
+    # Refused by the rate limit, then offered again on the next evaluate
+    assert run([True, True], [False, True]) == 2
+    # Also when not detected again, and only until accepted
+    assert run([True, False, False, False], [False, False, True]) == 3
+
+
+class FakeDHT:
+    """Stands in for websocket.create_connection, refusing the first
+    refuse connects and failing the first fail sends."""
+
+    def __init__(self, refuse=0, fail=0):
+        self.refuse = refuse
+        self.fail = fail
+        self.sent = []
+
+    def __call__(self, url, timeout=None):
+        if self.refuse:
+            self.refuse -= 1
+            raise ConnectionRefusedError()
+        return self
+
+    def send(self, message):
+        if self.fail:
+            self.fail -= 1
+            raise BrokenPipeError()
+        self.sent.append(message)
+
+    def close(self):
+        pass
+
+
+def test_publisher_reconnects(monkeypatch):
+    dht = FakeDHT(refuse=1, fail=1)
+    monkeypatch.setattr(publisher.websocket, "create_connection", dht)
+
+    dht_pub = publisher.DHTPublisher(min_backoff=0.01, batch_size=4)
+    for n in range(10):
+        assert dht_pub.publish({"n": n})
+    dht_pub.start()
+    deadline = time.monotonic() + 5
+    while len(dht.sent) < 10 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    dht_pub.stop()
+    dht_pub.join(timeout=5)
+
+    # A refused connect and a failed send, nothing lost or reordered
+    assert dht.sent == ['{"n": %d}' % n for n in range(10)]
+    stats = dht_pub.as_dict()
+    assert stats["connects"] == stats["failures"] == 2
+    assert stats["sent"] == 10
+    assert stats["queued"] == stats["dropped"] == 0
+
+
+def test_publisher_limits():
+    dht_pub = publisher.DHTPublisher(capacity=3)
+    for n in range(5):
+        dht_pub.publish(n)
+
+    # The oldest are dropped, also when a failed batch goes back
+    assert [message for _, message in dht_pub.items] == ["2", "3", "4"]
+    dht_pub.requeue([(0.0, "1")])
+    assert dht_pub.as_dict()["dropped"] == 3
+
+    dht_pub = publisher.DHTPublisher(rate_limit=2)
+    assert [dht_pub.publish(n) for n in range(3)] == [True, True, False]
+    assert dht_pub.as_dict()["rate_limited"] == 1
+    assert len(dht_pub.items) == 2
+
+
+def test_ingest_drop_policies():
+    for policy, kept in (
+        (ingest.Policy.DropNewest, [0, 1]),
+        (ingest.Policy.DropOldest, [1, 2]),
+    ):
+        queue = ingest.IngestQueue(2, policy)
+        results = [queue.put(n) for n in range(3)]
+        assert results == [True, True, policy is ingest.Policy.DropOldest]
+        assert queue.get_batch() == kept
+        assert queue.as_dict()["dropped"] == {
+            p.value: int(p is policy)
+            for p in (
+                ingest.Policy.DropNewest,
+                ingest.Policy.DropOldest,
+                ingest.Policy.FlowSample,
+            )
+        }
+
+
+def test_ingest_block_policy():
+    queue = ingest.IngestQueue(1, ingest.Policy.Block)
+    queue.put(0)
+    results = []
+
+    def put(item):
+        results.append(queue.put(item))
+
+    # Blocks until get_batch() makes room
+    producer = threading.Thread(target=put, args=(1,))
+    producer.start()
+    producer.join(timeout=0.1)
+    assert producer.is_alive()
+    assert queue.get_batch() == [0]
+    producer.join(timeout=5)
+    assert results == [True]
+
+    # Or until the queue is closed
+    producer = threading.Thread(target=put, args=(2,))
+    producer.start()
+    producer.join(timeout=0.1)
+    assert producer.is_alive()
+    queue.close()
+    producer.join(timeout=5)
+    assert results == [True, False]
+    assert queue.get_batch() == [1]
+    assert queue.as_dict()["blocked"] == 2
+
+
+def test_ingest_flow_sample_policy():
+    # Items are (flow, packet), hashed by flow
+    queue = ingest.IngestQueue(
+        1000, ingest.Policy.FlowSample, flow_hash=lambda item: item[0]
+    )
+    for n in range(queue.sample_from):
+        queue.put((0, n))
+
+    # Past half full, half of the flows are admitted, all their packets
+    for packet in range(2):
+        for flow in range(1, 9):
+            queue.put((flow, packet))
+    flows = {}
+    for flow, packet in queue.get_batch()[queue.sample_from :]:
+        flows.setdefault(flow, []).append(packet)
+    assert flows == {flow: [0, 1] for flow in (2, 4, 6, 8)}
+    assert queue.as_dict()["dropped"]["flow-sample"] == 8
+
+    # A full queue drops what sampling lets through, under the same policy
+    queue = ingest.IngestQueue(
+        4, ingest.Policy.FlowSample, flow_hash=lambda item: 0
+    )
+    for n in range(5):
+        queue.put(n)
+    dropped = queue.as_dict()["dropped"]
+    assert dropped["flow-sample"] == 1
+    assert dropped["drop-newest"] == 0
+
+
+def test_packet_sampling_weights():
+    connlist = traffic.conn_list()
+    connlist.sample_shift = 2
+    frame = tcp_frame("198.51.100.1", str(LOCAL_IP), 5000, 443, ACK, 60)
+    for n in range(100):
+        record(connlist, frame, T0 + n)
+
+    # The first packets exactly, then 1 in 4 standing for the other 3
+    (conn,) = connlist.conns
+    assert len(conn.data) == connlist.exact_packets == 20
+    assert conn.sampled == 20 + 80 // 4
+    assert conn.sample_rate() == 0.4
+    assert sum(conn.data.total_packets()) == 100
+    assert sum(conn.data.total_bytes()) == 100 * 100
+
+
+def test_sampling_controller(monkeypatch):
+    clock = [0.0]
+    cpu = [0.0]
+    monkeypatch.setattr(ingest.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(
+        ingest.os,
+        "times",
+        lambda: types.SimpleNamespace(user=cpu[0], system=0.0),
+    )
+    sampler = ingest.SamplingController(100)
+
+    def tick(depth, cpu_time=0.0):
+        clock[0] += 1.0
+        cpu[0] += cpu_time
+        return sampler.update(depth)
+
+    # Not before an interval has passed, deepest queue seen counts
+    clock[0] = 0.5
+    assert sampler.update(30) == 0
+    clock[0] = 0.0
+    assert tick(10) == 1
+    assert tick(30) == 2
+    assert sampler.as_dict()["rate"] == 0.25
+    assert tick(10) == 2  # between the marks
+    assert tick(1) == 1
+    assert tick(1) == 0
+    assert tick(1) == 0
+    assert tick(1, cpu_time=0.95) == 1
+    assert tick(1, cpu_time=0.7) == 1  # CPU not below its low mark
+    assert sampler.as_dict()["changes"] == 5
+
+
+def test_periodic_timer_survives_errors():
+    calls = []
+
+    def callback():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("first tick fails")
+        timer.stop()
+
+    timer = ingest.PeriodicTimer(0.01, callback)
+    timer.start()
+    timer.join(timeout=5)
+    assert len(calls) == 2
+
+
+def new_anomaly(n, category=aud.Category.FrequentFlow):
+    key = aud.ACLKey(
+        ip_ver=4,
+        direction="inbound",
+        proto=6,
+        addr=ipaddress.ip_address(0x0A000000 + n),
+        svc_port=443,
+    )
+    conn = types.SimpleNamespace(
+        get_acl_key=lambda: key, get_freq_key=lambda: key
+    )
+    return aud.Anomaly(category=category, conn=conn, score=1.0)
+
+
+def uuids(items):
+    return [item["anomaly_uuid"] for item in items]
+
+
+def test_anomaly_store_query():
+    store = aud.AnomalyStore()
+    anomalies = [
+        new_anomaly(
+            n, (aud.Category.FrequentFlow, aud.Category.HeavyHitter)[n % 2]
+        )
+        for n in range(10)
+    ]
+    for anomaly in anomalies:
+        store.add(anomaly)
+    everything = [str(anomaly.uuid) for anomaly in anomalies]
+
+    # Without a cursor, the latest ones
+    items, cursor = store.query(limit=4)
+    assert uuids(items) == everything[-4:]
+    assert cursor == anomalies[-1].seq
+
+    pages = []
+    cursor = -1
+    while True:
+        items, cursor = store.query(cursor=cursor, limit=4)
+        if not items:
+            break
+        pages.append(uuids(items))
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert sum(pages, []) == everything
+
+    items, _ = store.query(cursor=-1, category=aud.Category.HeavyHitter)
+    assert uuids(items) == everything[1::2]
+
+    # Update times as if one anomaly was added per second
+    store.times[:] = range(10)
+    items, _ = store.query(since=7)
+    assert uuids(items) == everything[7:]
+
+    # An update moves an anomaly to the end of the log
+    cursor = anomalies[-1].seq
+    anomalies[2].update(2.0)
+    store.add(anomalies[2])
+    assert uuids(store.query(cursor=cursor)[0]) == [everything[2]]
+    items, _ = store.query(since=7)
+    assert uuids(items) == everything[7:] + [everything[2]]
+    assert len(uuids(store.query()[0])) == 10
+
+
+def test_anomaly_store_retention():
+    store = aud.AnomalyStore(retention=3)
+    anomalies = [new_anomaly(n) for n in range(4)]
+    for anomaly in anomalies[:3]:
+        store.add(anomaly)
+
+    # The least recently added or updated one is evicted
+    store.add(anomalies[0])
+    store.add(anomalies[3])
+    assert len(store) == 3
+    assert anomalies[1] not in store
+    assert [a.uuid for a in store] == [anomalies[n].uuid for n in (2, 0, 3)]
+
+    with pytest.raises(ValueError):
+        aud.AnomalyStore(retention=0)
+
+
+def test_anomaly_store_compaction():
+    store = aud.AnomalyStore()
+    anomaly = new_anomaly(0)
+    store.add(new_anomaly(1))
+    for _ in range(1000):
+        store.add(anomaly)
+
+    # Stale log entries are dropped as they pile up
+    assert len(store.seqs) <= 2 * len(store) + 65
+    assert len(store.seqs) == len(store.times)
+    items, _ = store.query(cursor=-1)
+    assert len(items) == 2
+    items, _ = store.query(category=aud.Category.FrequentFlow)
+    assert uuids(items)[-1] == str(anomaly.uuid)
+
+
+def test_mark_benign():
+    handle = aud.AUD()
+    anomaly, other = new_anomaly(0), new_anomaly(1)
+    for a in (anomaly, other):
+        handle.anomalies.add(a)
+        handle.open_anomalies[aud.anomaly_key(a.category, a.conn)] = a
+
+    assert handle.mark_benign(str(anomaly.uuid)) == "OK"
+    assert anomaly not in handle.anomalies
+    assert list(handle.open_anomalies.values()) == [other]
+    assert uuids(handle.anomalies.query()[0]) == [str(other.uuid)]
+
+    assert handle.mark_benign(str(anomaly.uuid)) == "anomaly UUID not found"
+    assert handle.mark_benign("not-a-uuid") == "ValueError"
+
+    assert handle.mark_benign("all") == "OK"
+    assert len(handle.anomalies) == 0
+    assert handle.anomalies.query() == ([], None)
+
+
+def test_fanout_export_collect():
+    capture = fanout.FanoutCapture(
+        2, "socket", 96, traffic.Host().local_addrs, 10, 1024, None, "off"
+    )
+    for worker in capture.workers:
+        connlist = traffic.conn_list(worker)
+        connlist.clock = lambda: T0 + 10 * 1000000000
+        remote = "198.51.100.%d" % (worker.index + 1)
+        for _, frame in handshake(remote, 5000, T0):
+            record(connlist, frame)
+        worker.export(connlist, ingest.IngestQueue(1024))
+        # Released after the export, the queued copy is unaffected
+        (conn,) = connlist.conns
+        assert conn.marked_for_deletion
+
+    handle = aud.AUD()
+    batches = []
+    deadline = time.monotonic() + 5
+    while len(batches) < 2 and time.monotonic() < deadline:
+        batches.extend(capture.collect())
+    assert not any(
+        conn.marked_for_deletion for batch in batches for conn in batch.conns
+    )
+    for batch in batches:
+        handle.update(batch)
+
+    assert capture.batches == capture.conns == [1, 1]
+    assert sorted(str(key.addr) for key in handle.records) == [
+        "198.51.100.1",
+        "198.51.100.2",
+    ]
+
+
+def test_bucket_statistics():
+    lengths = [60, 1500, 40, 576, 1500, 52, 1200, 90, 40, 1380]
+
+    def check(bucket, data, direction=0):
+        assert bucket.get_count(direction) == len(data)
+        assert bucket.get_sum(direction) == sum(data)
+        assert abs(bucket.get_mean(direction) - statistics.mean(data)) < 1e-9
+        assert abs(bucket.get_stdev(direction) - statistics.stdev(data)) < 1e-9
+        assert bucket.get_min(direction) == min(data)
+        assert bucket.get_max(direction) == max(data)
+
+    whole, first, second = aud.Bucket(), aud.Bucket(), aud.Bucket()
+    for n, plen in enumerate(lengths):
+        whole.add(plen, 0)
+        (first if n < 4 else second).add(plen, 0)
+    check(whole, lengths)
+
+    # Chan merge of two partial buckets, and into an empty one
+    first.merge(second)
+    check(first, lengths)
+    empty = aud.Bucket()
+    empty.merge(first)
+    check(empty, lengths)
+    assert empty.get_count(1) == 0
+
+    # A weight stands for that many packets of the same length
+    weighted = aud.Bucket()
+    for plen in lengths:
+        weighted.add(plen, 1, weight=3)
+    check(weighted, [plen for plen in lengths for _ in range(3)], 1)
+
+
+def flow_features(fwd_bytes=1000):
+    return (fwd_bytes, 2000, 10, 12, 100)
+
+
+def test_feature_store_scores():
+    store = features.FeatureStore(depth=8, min_samples=3)
+    young, old = store.add_row(), store.add_row()
+    for n in range(3):
+        if n < 2:
+            store.push(young, flow_features(), 0, "young")
+        store.push(old, flow_features(), 0, "old")
+        assert store.evaluate() == []
+
+    # No score below min_samples, then a log1p z-score past z_thresh
+    store.push(young, flow_features(10**6), 0, "young")
+    store.push(old, flow_features(1100), 0, "old")
+    store.push(old, flow_features(10**6), 0, "old outlier")
+    ((conn, score),) = store.evaluate()
+    assert conn == "old outlier"
+    expected = (np.log1p(10**6) - np.log1p(1000)) / store.min_std
+    assert abs(score - expected) < 1e-6
+
+
+def test_feature_store_commit():
+    store = features.FeatureStore(depth=4)
+    row, other = store.add_row(), store.add_row()
+    for n in range(6):
+        store.push(row, flow_features(n), 0, None)
+        store.evaluate()
+
+    # The ring keeps the last depth flows, oldest first
+    assert store.seen[row] == 6
+    assert store.history(row)[:, 0].tolist() == [2, 3, 4, 5]
+
+    # Flows of one row in one batch take consecutive slots, in order
+    for n in (6, 7, 8):
+        store.push(row, flow_features(n), n, None)
+        store.push(other, flow_features(100 + n), n, None)
+    store.evaluate()
+    assert store.seen[row] == 9
+    assert store.history(row)[:, 0].tolist() == [5, 6, 7, 8]
+    assert store.history(other)[:, 0].tolist() == [106, 107, 108]
+    assert store.peps[other, :3].tolist() == [6, 7, 8]
+
+
+def test_pcap_reader(tmp_path):
+    frames = [
+        (T0, tcp_frame("198.51.100.1", str(LOCAL_IP), 5000, 443, SYN)),
+        (T0 + 5, tcp_frame(str(LOCAL_IP), "198.51.100.1", 443, 5000, ACK)),
+        (T0 + 9, tcp_frame("198.51.100.1", "198.51.100.2", 1, 2, SYN)),
+    ]
+    reader = pcapreader.PcapReader(None, write_trace(tmp_path, frames))
+    reader.attach_filter(traffic.Host().local_addrs)
+
+    pkts = list(reader.sock_reader())
+    assert [(l3.ts, l3.direction) for l3, _ in pkts] == [
+        (T0, socket.PACKET_HOST),
+        (T0 + 5, socket.PACKET_OUTGOING),
+    ]
+    assert pkts[0][1] == (5000, 443, SYN)
+    assert reader.skipped == 1
+
+
+def test_pcapng_reader(tmp_path):
+    frame = tcp_frame("198.51.100.1", str(LOCAL_IP), 5000, 443, SYN)
+    # if_tsresol 9: nanosecond timestamps
+    options = struct.pack("<HHB3xHH", 9, 1, 9, 0, 0)
+    idb = struct.pack("<HHI", 1, 0, 0) + options
+    epb = struct.pack("<IIIII", 0, T0 >> 32, T0 & 0xFFFFFFFF, 54, 54)
+    epb += frame + bytes(2)
+
+    def block(block_type, body):
+        length = 12 + len(body)
+        head = struct.pack("<II", block_type, length)
+        return head + body + struct.pack("<I", length)
+
+    shb = struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)
+    path = tmp_path / "trace.pcapng"
+    path.write_bytes(block(0x0A0D0D0A, shb) + block(1, idb) + block(6, epb))
+
+    reader = pcapreader.PcapReader(None, str(path))
+    reader.attach_filter(traffic.Host().local_addrs)
+    ((l3hdr, l4hdr),) = reader.sock_reader()
+    assert l3hdr.ts == T0
+    assert l3hdr.direction == socket.PACKET_HOST
+    assert l4hdr.flags == SYN
+
+
+def test_replay_closed_flows(tmp_path):
+    frames = []
+    for n in range(20):
+        frames += handshake("198.51.100.%d" % (n + 1), 40000 + n, T0 + n)
+    frames.sort()
+
+    run = replay(write_trace(tmp_path, frames))
+
+    # Closed by FIN/FIN, so expired and aggregated within one interval
+    assert run.packets == 100
+    assert len(run.aud.records) == 20
+    assert all(
+        len(record.aggregator) == 1 for record in run.aud.records.values()
+    )
+    assert len(run.updates) == len(run.evaluates) == 1
+
+
+def test_snapshot_round_trip(tmp_path):
+    frames = []
+    for n in range(20):
+        frames += handshake("198.51.100.%d" % (n % 4 + 1), 40000 + n, T0 + n)
+    frames.sort()
+    saved = replay(write_trace(tmp_path, frames)).aud
+    saved.learning = True
+
+    directory = str(tmp_path / "snapshots")
+    for _ in range(3):
+        snapshot.write(directory, snapshot.capture(saved))
+    assert len(snapshot.list_snapshots(directory)) == snapshot.KEEP
+
+    restored = aud.AUD()
+    assert snapshot.restore(restored, snapshot.load_latest(directory))
+
+    assert restored.learning
+    assert list(restored.records) == list(saved.records)
+    for key, record in saved.records.items():
+        agg, copy = record.aggregator, restored.records[key].aggregator
+        assert (copy.row, copy.samples) == (agg.row, agg.samples)
+        assert [b.stats for b in copy.buckets] == [
+            b.stats for b in agg.buckets
+        ]
+        assert copy.pep_dist.counts == agg.pep_dist.counts
+    for name in snapshot.ARRAYS:
+        rows = saved.features.rows
+        assert (
+            getattr(restored.features, name)[:rows]
+            == getattr(saved.features, name)[:rows]
+        ).all()
+    assert restored.features.rows == saved.features.rows
+    assert restored.freq_counter.counters == saved.freq_counter.counters
+    assert restored.sketches.talkers.top() == saved.sketches.talkers.top()
+    assert restored.sketches.rates.table == saved.sketches.rates.table
+    assert restored.sketches.as_dict() == saved.sketches.as_dict()
+
+
+def test_snapshot_mismatch(tmp_path, monkeypatch):
+    saved = aud.AUD()
+    directory = str(tmp_path)
+    snapshot.write(directory, snapshot.capture(saved))
+    saved.learning = True
+    monkeypatch.setattr(snapshot, "SNAPSHOT_VERSION", 0)
+    snapshot.write(directory, snapshot.capture(saved))
+    monkeypatch.undo()
+
+    # The newest one is of another version, the older one is loaded
+    meta, arrays = snapshot.load_latest(directory)
+    assert meta["version"] == snapshot.SNAPSHOT_VERSION
+    assert not meta["learning"]
+
+    # Records that would not get their saved rows back
+    meta["records"] = [(None, 0, None, 0, 5, [], ({}, {}, 0))]
+    handle = aud.AUD()
+    assert not snapshot.restore(handle, (meta, arrays))
+    assert not handle.records
+
+
+def test_tcp_state_expiry():
+    connlist = traffic.conn_list()
+    connlist.clock = lambda: T0 + 6 * 1000000000
+
+    local = str(LOCAL_IP)
+    for remote, reset in (("198.51.100.1", True), ("198.51.100.2", False)):
+        record(connlist, tcp_frame(remote, local, 5000, 443, SYN))
+        if reset:
+            record(connlist, tcp_frame(local, remote, 443, 5000, RST))
+
+    reset, pending = connlist.conns
+    assert reset.timeout == aud_conn.TCP_LINGER
+    assert pending.timeout == aud_conn.TCP_HANDSHAKE_TIMEOUT
+    assert reset.half_open() and pending.half_open()
+
+    # Reset flows linger 5 s, unanswered SYNs wait 30 s
+    connlist.trim()
+    assert connlist.closed == [reset]
+
+
+def test_replay_half_open_flood(tmp_path):
+    frames = []
+    for n in range(50):
+        remote = "203.0.113.%d" % (n + 1)
+        frames.append(
+            (T0 + n, tcp_frame(remote, str(LOCAL_IP), 30000 + n, 443, SYN))
+        )
+    # Trace long enough for the handshake timeout to pass
+    frames += handshake("198.51.100.1", 40000, T0 + 40 * 1000000000)
+
+    run = replay(write_trace(tmp_path, frames), half_open_thresh=20)
+
+    # 50 new connections in 30 s also makes a FrequentFlow
+    categories = {anomaly.category for anomaly in run.aud.anomalies}
+    assert aud.Category.HalfOpenFlood in categories
+
+
+def test_replay_on_trace_time(tmp_path):
+    # Two floods an hour apart in the trace, replayed in well under that
+    hour = 3600 * 1000000000
+    frames = []
+    for start in (T0, T0 + hour):
+        for n in range(50):
+            remote = "203.0.113.%d" % (n + 1)
+            frame = tcp_frame(remote, str(LOCAL_IP), 30000 + n, 443, SYN)
+            frames.append((start + n, frame))
+    frames += handshake("198.51.100.1", 40000, T0 + hour + 40 * 1000000000)
+
+    run = replay(write_trace(tmp_path, frames), half_open_thresh=20)
+
+    # Closed in between, so raised twice, at trace times
+    floods = [
+        anomaly
+        for anomaly in run.aud.anomalies
+        if anomaly.category is aud.Category.HalfOpenFlood
+    ]
+    assert len(floods) == 2
+    assert abs(floods[1].seen - floods[0].seen - hour) < hour // 60
+    assert floods[0].last_seen == aud.utc_time(floods[0].seen)
+    assert floods[0].time.timestamp() // 3600 == T0 // hour
+    times = run.aud.anomalies.times
+    assert times[0] >= T0 / 1e9 and times[-1] < (T0 + 2 * hour) / 1e9
+
+
+def test_as_resolver(tmp_path):
+    path = tmp_path / "asn.csv"
+    path.write_text(
+        "# prefix,asn\n"
+        "10.0.0.0/8,100\n"
+        "10.1.0.0/16,AS200\n"
+        "10.1.2.0/24,300\n"
+        "11.0.0.0,11.0.0.255,400,FI\n"
+        "2001:db8::/32\t500\n"
+    )
+    resolver = asresolver.ASResolver(str(path))
+
+    def lookup(addr):
+        return resolver.lookup(ipaddress.ip_address(addr))
+
+    assert lookup("10.9.0.1") == 100
+    assert lookup("10.1.9.1") == 200
+    assert lookup("10.1.2.3") == 300
+    assert lookup("10.2.0.0") == 100
+    assert lookup("11.0.0.7") == 400
+    assert lookup("2001:db8::1") == 500
+    assert lookup("192.0.2.1") is None
+    assert os.path.exists(str(path) + asresolver.INDEX_SUFFIX)
+
+
+def test_as_resolver_unwritable_index(tmp_path):
+    path = tmp_path / "asn.csv"
+    path.write_text("10.0.0.0/8,100\n")
+    resolver = asresolver.ASResolver(str(path), check_interval=0)
+    # Like a read-only mount: the index cannot be written next to it
+    resolver.index = str(tmp_path / "missing" / "asn.csv.idx")
+
+    assert resolver.lookup(ipaddress.ip_address("10.0.0.1")) == 100
+    assert resolver.lookup(ipaddress.ip_address("10.0.0.2")) == 100
+    # Served from memory, not parsed again while the dataset is unchanged
+    assert resolver.loads == 1
+
+    path.write_text("10.0.0.0/8,200\n")
+    os.utime(path, ns=(0, resolver.mtime + 1))
+    assert resolver.lookup(ipaddress.ip_address("10.0.0.1")) == 200
+    assert resolver.loads == 2
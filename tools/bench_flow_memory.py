@@ -0,0 +1,66 @@
+"""Report the memory held per tracked flow by aud_conn.ConnList.
+
+Usage: python3 tools/bench_flow_memory.py [flows] [packets_per_flow]
+"""
+import ipaddress
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "aud_manager"
+    ),
+)
+
+# Local imports
+import packetreader as pr  # noqa: E402
+import traffic  # noqa: E402
+from traffic import LOCAL_IP, T0  # noqa: E402
+
+PACKET_GAP = 5 * 1000000000  # spreads packets over several buckets
+
+
+def packets(flows, per_flow):
+    for n in range(per_flow):
+        for flow in range(flows):
+            remote = ipaddress.ip_address(0x0A000000 + flow).packed
+            ts = T0 + n * PACKET_GAP + flow
+            if n % 2:
+                l3hdr = pr.IPv4Packet(
+                    ts, 1500, 64, 6, remote, LOCAL_IP.packed, 0
+                )
+                l4hdr = pr.TCPHeader(443, 40000 + flow % 20000, 0x10)
+            else:
+                l3hdr = pr.IPv4Packet(
+                    ts, 60, 64, 6, LOCAL_IP.packed, remote, 4
+                )
+                l4hdr = pr.TCPHeader(40000 + flow % 20000, 443, 0x10)
+            yield l3hdr, l4hdr
+
+
+def main():
+    flows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    per_flow = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    pkts = list(packets(flows, per_flow))
+
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+
+    connlist = traffic.conn_list()
+    for pkt in pkts:
+        connlist.record(pkt)
+
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        "%d flows, %d packets each: %d bytes per flow"
+        % (len(connlist), per_flow, (used - base) // len(connlist))
+    )
+
+
+if __name__ == "__main__":
+    main()
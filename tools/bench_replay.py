@@ -0,0 +1,151 @@
+"""Replay a packet trace through ConnList and AUD on trace time, and report
+packets per second, aud_update / aud_evaluate latency percentiles and
+memory per tracked flow as JSON. Without a trace, a synthetic one is
+generated. Exits non-zero below --min-pps, for use in CI.
+
+Usage: python3 tools/bench_replay.py [--trace file.pcap --local-ip IP]...
+           [--flows N] [--packets N] [--min-pps N]
+"""
+import argparse
+import ipaddress
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "aud_manager"
+    ),
+)
+
+# Local imports
+import aud  # noqa: E402
+import aud_conn  # noqa: E402
+import pcapreader  # noqa: E402
+from traffic import LOCAL_IP, T0, Host, tcp_frame  # noqa: E402
+
+FLOW_GAP = 10000000  # 100 new flows per second
+PACKET_GAP = 200000000
+
+
+def synthetic_frames(flows, packets):
+    """Inbound HTTPS-like flows from flows remote addresses spread over
+    a few /16s, packets each: handshake, request / response pairs,
+    FIN / FIN."""
+
+    frames = []
+    for flow in range(flows):
+        remote = ipaddress.ip_address(0x0A000000 + (flow * 7919) % 0x40000)
+        sport = 1024 + flow % 60000
+        t = T0 + flow * FLOW_GAP
+
+        exchange = [
+            (remote, LOCAL_IP, 0x02, 0),
+            (LOCAL_IP, remote, 0x12, 0),
+            (remote, LOCAL_IP, 0x10, 0),
+        ]
+        for n in range(max(packets - 6, 0)):
+            if n % 2:
+                exchange.append((LOCAL_IP, remote, 0x18, 1400))
+            else:
+                exchange.append((remote, LOCAL_IP, 0x18, 200))
+        exchange += [
+            (remote, LOCAL_IP, 0x11, 0),
+            (LOCAL_IP, remote, 0x11, 0),
+            (remote, LOCAL_IP, 0x10, 0),
+        ]
+
+        for n, (src, dst, flags, payload) in enumerate(exchange):
+            sp, dp = (sport, 443) if src == remote else (443, sport)
+            frame = tcp_frame(src, dst, sp, dp, flags, payload)
+            frames.append((t + n * PACKET_GAP, frame))
+
+    frames.sort(key=lambda f: f[0])
+    return frames
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def pick(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    return {
+        "p50_ms": round(1000 * pick(0.5), 3),
+        "p95_ms": round(1000 * pick(0.95), 3),
+        "p99_ms": round(1000 * pick(0.99), 3),
+        "max_ms": round(1000 * values[-1], 3),
+    }
+
+
+def replay(path, local_ips, interval):
+    handle = Host(local_ips)
+    reader = pcapreader.PcapReader(None, path)
+    reader.attach_filter(handle.local_addrs)
+    connlist = aud_conn.ConnList(handle)
+    run = pcapreader.Replay(reader, connlist, aud.AUD(), interval)
+    run.run()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace")
+    parser.add_argument("--local-ip", action="append", default=[])
+    parser.add_argument("--flows", type=int, default=5000)
+    parser.add_argument(
+        "--packets", type=int, default=20, help="per synthetic flow"
+    )
+    parser.add_argument("--interval", type=int, default=10)
+    parser.add_argument("--min-pps", type=float, default=0)
+    args = parser.parse_args()
+
+    path = args.trace
+    local_ips = [ipaddress.ip_address(ip) for ip in args.local_ip]
+    tmp = None
+    if path is None:
+        tmp = tempfile.NamedTemporaryFile(suffix=".pcap")
+        pcapreader.write_pcap(tmp, synthetic_frames(args.flows, args.packets))
+        tmp.flush()
+        path = tmp.name
+        local_ips = [LOCAL_IP]
+
+    start_t = time.perf_counter()
+    run = replay(path, local_ips, args.interval)
+    elapsed = time.perf_counter() - start_t
+
+    # Again under tracemalloc, which slows the replay down too much to
+    # time it in the same pass
+    tracemalloc.start()
+    mem_run = replay(path, local_ips, args.interval)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pps = run.packets / elapsed if elapsed else 0.0
+    report = {
+        "trace": args.trace or "synthetic",
+        "packets": run.packets,
+        "peak_flows": mem_run.peak_flows,
+        "seconds": round(elapsed, 3),
+        "packets_per_s": round(pps),
+        "aud_update": percentiles(run.updates),
+        "aud_evaluate": percentiles(run.evaluates),
+        # Everything the replay holds at its peak, per flow tracked then
+        "peak_bytes": peak,
+        "bytes_per_flow": peak // max(mem_run.peak_flows, 1),
+    }
+    print(json.dumps(report, indent=2))
+
+    if pps < args.min_pps:
+        print("%d packets/s is below %d" % (pps, args.min_pps))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Publish synthetic anomalies through publisher.DHTPublisher and report
+its counters. Run tools/websocket_sink.py first, or start the sink later
+to see the publisher reconnect.
+
+Usage: python3 tools/publish_to_sink.py [messages] [url]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "aud_manager"
+    ),
+)
+
+# Local imports
+import publisher  # noqa: E402
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    url = sys.argv[2] if len(sys.argv) > 2 else publisher.DEFAULT_DHT_URL
+
+    pub = publisher.DHTPublisher(url, capacity=messages)
+    pub.start()
+
+    start_t = time.time()
+    for n in range(messages):
+        pub.publish({"RequestPostTopicUUID": {"value": {"seq": n}}})
+
+    while pub.sent + pub.dropped < messages and time.time() - start_t < 60:
+        time.sleep(0.1)
+
+    elapsed = time.time() - start_t
+    pub.stop()
+    pub.join()
+
+    print(json.dumps(pub.as_dict(), indent=2))
+    print("%d messages in %f seconds" % (pub.sent, round(elapsed, 3)))
+
+
+if __name__ == "__main__":
+    main()